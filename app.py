@@ -1,30 +1,98 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, stream_with_context, g, abort
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import os
+import bisect
 import hashlib
 import json
+import time
 import uuid
 
 from database.db import init_db, verify_user, add_user, get_all_users, delete_user, get_db_connection
-from database.db import add_material, get_materials, get_subjects, get_user_subjects, assign_user_subject
+from database.db import add_material, get_materials, get_subjects, get_user_subjects, assign_user_subjects
+from database.db import get_all_user_subjects, import_roster
 from database.db import get_material_by_id, delete_material, update_material_indexed
 from database.db import add_subject, delete_subject, update_subject
 from database.db import get_user_by_id, update_user, remove_user_subjects
-from database.db import create_quiz, get_teacher_quizzes, get_student_quizzes, get_quiz_by_id, log_quiz_result, assign_quiz_to_students
-from database.db import update_quiz_questions
-from database.db import log_qa, get_qa_logs, add_qa_correction, get_qa_corrections
+from database.db import create_quiz, get_teacher_quizzes, get_student_quizzes, get_quiz_status, get_quiz_by_id, assign_quiz_to_students
+from database.db import add_quiz_question, add_quiz_questions, delete_quiz_question, get_quiz_stats, get_subject_mastery, get_question_bank_stats
+from database.db import chunk_ref, get_qa_logs, add_qa_correction, get_qa_corrections, get_stage_timings
 from database.db import create_note, get_user_notes, get_note_by_id, update_note, delete_note
+from database.db import get_chat_contacts, add_chat_message, get_chat_latest_id, get_conversation_messages
 from utils.auth import login_required, admin_required, teacher_required, login_user, logout_user, get_current_user
 from services.rag_service import get_rag_system
+from services.log_writer import get_log_writer, utc_timestamp
+from services.socket_queue import get_client_manager
+from services.chat_batcher import EmitBatcher
+from services.presence import PresenceService, user_room
+from services.dedup import get_subject_index
+from services.chat_store import get_chat_store, chat_session_id
+from services.profiler import get_profiler, collapsed_text
 from rank_bm25 import BM25Okapi
-from utils.config import UPLOAD_FOLDER, MAX_FILE_SIZE, SECRET_KEY
+from utils.config import UPLOAD_FOLDER, MAX_FILE_SIZE, SECRET_KEY, SOCKETIO_MESSAGE_QUEUE, LATENCY_BUCKETS_MS, METRICS_TOKEN
 from utils.file_utils import allowed_file
+from utils.roster import parse_roster_csv
+from utils.metrics import registry as metrics
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", client_manager=get_client_manager(SOCKETIO_MESSAGE_QUEUE))
+chat_emitter = EmitBatcher(socketio)
+presence = PresenceService(socketio)
+
+http_requests = metrics.counter('http_requests_total', 'HTTP requests by route and status', ('method', 'endpoint', 'status'))
+http_latency = metrics.histogram('http_request_duration_seconds', 'HTTP request latency by route', ('method', 'endpoint'))
+socket_connections = metrics.gauge('socketio_connections', 'Open Socket.IO connections')
+socket_messages = metrics.counter('socketio_messages_total', 'Chat messages sent over Socket.IO', ('outcome',))
+
+if metrics.enabled:
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_requests.inc(request.method, endpoint, str(response.status_code))
+        if 'request_start' in g:
+            http_latency.observe(time.perf_counter() - g.request_start, request.method, endpoint)
+        return response
+
+profiler = get_profiler()
+
+@app.before_request
+def start_request_profile():
+    force = request.args.get('_profile')
+    if force and session.get('role') != 'admin':
+        force = None
+    if profiler.sample_rate <= 0 and not force:
+        return
+    if request.endpoint and request.endpoint.startswith('profiler'):
+        return
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.profile_token = profiler.start(route, request.method, request.path, force=force if force in ('sample', 'cprofile') else None)
+
+@app.after_request
+def finish_request_profile(response):
+    token = g.pop('profile_token', None)
+    if token is not None:
+        profiler.finish(token, response.status_code)
+    return response
+
+@app.teardown_request
+def abandon_request_profile(error=None):
+    token = g.pop('profile_token', None)
+    if token is not None:
+        profiler.finish(token, 500)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        abort(404)
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -54,6 +122,8 @@ def login():
 
 @app.route('/logout')
 def logout():
+    if 'chat_sid' in session:
+        get_chat_store().clear(session['chat_sid'])
     logout_user()
     return redirect(url_for('login'))
 
@@ -70,8 +140,7 @@ def admin():
             try:
                 uid = add_user(username, password, role)
                 if subject_ids and role in ['student', 'teacher']:
-                    for sid in subject_ids:
-                        assign_user_subject(uid, sid)
+                    assign_user_subjects([(uid, sid) for sid in subject_ids])
                 flash(f'User {username} created successfully!', 'success')
             except Exception as e:
                 flash(f'Error: {str(e)}', 'error')
@@ -86,19 +155,118 @@ def admin():
                     update_user(user_id, username, password if password else None, role)
                     if role in ['student', 'teacher']:
                         remove_user_subjects(user_id)
-                        for sid in subject_ids:
-                            assign_user_subject(user_id, sid)
+                        assign_user_subjects([(user_id, sid) for sid in subject_ids])
                     flash(f'User {username} updated successfully!', 'success')
             except Exception as e:
                 flash(f'Error: {str(e)}', 'error')
     users = get_all_users()
     subjects = get_subjects()
+    all_user_subjects = get_all_user_subjects()
     for user in users:
-        user_subjects = get_user_subjects(user['id'])
+        user_subjects = all_user_subjects.get(user['id'], [])
         user['subjects'] = user_subjects
         user['subject_ids'] = [s['id'] for s in user_subjects]
     return render_template('admin.html', users=users, subjects=subjects)
 
+@app.route('/admin/import_roster', methods=['POST'])
+@admin_required
+def import_roster_route():
+    roster = request.files.get('roster')
+    if not roster or not roster.filename:
+        flash('Please choose a CSV file', 'error')
+        return redirect(url_for('admin'))
+    try:
+        rows, errors = parse_roster_csv(roster.stream)
+        report = import_roster(rows)
+        report['errors'] = [f'line {line_no}: {message}' for line_no, message in errors]
+    except Exception as e:
+        flash(f'Error: {str(e)}', 'error')
+        return redirect(url_for('admin'))
+    if request.args.get('format') == 'json':
+        return jsonify(dict(report, success=True))
+    flash(f"Roster imported: {report['users_created']} users created, {report['users_existing']} already existed, {report['memberships_added']} subject memberships added", 'success')
+    if errors:
+        flash(f"{len(errors)} rows skipped: " + '; '.join(report['errors'][:10]), 'error')
+    return redirect(url_for('admin'))
+
+def latency_histograms(timings_list):
+    values = {}
+    for timings in timings_list:
+        for stage, ms in timings.items():
+            values.setdefault(stage, []).append(ms)
+    stages = []
+    for stage, samples in values.items():
+        samples.sort()
+        buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        for ms in samples:
+            buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        stages.append({
+            'stage': stage,
+            'count': len(samples),
+            'total_ms': round(sum(samples), 1),
+            'mean_ms': round(sum(samples) / len(samples), 1),
+            'p50_ms': round(samples[len(samples) // 2], 1),
+            'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+            'max_ms': round(samples[-1], 1),
+            'buckets': buckets
+        })
+    stages.sort(key=lambda s: s['total_ms'], reverse=True)
+    return stages
+
+@app.route('/admin/latency')
+@admin_required
+def rag_latency():
+    limit = max(1, min(request.args.get('limit', 2000, type=int), 20000))
+    timings_list = get_stage_timings(limit)
+    stages = latency_histograms(timings_list)
+    labels = [f'<{b}ms' for b in LATENCY_BUCKETS_MS] + [f'>={LATENCY_BUCKETS_MS[-1]}ms']
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'queries': len(timings_list), 'bucket_labels': labels, 'stages': stages})
+    return render_template('rag_latency.html', queries=len(timings_list), bucket_labels=labels, stages=stages)
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+@admin_required
+def profiler_admin():
+    if request.method == 'POST':
+        if request.form.get('action') == 'reset':
+            profiler.reset()
+            flash('Profiles cleared', 'success')
+        else:
+            try:
+                profiler.configure(sample_rate=float(request.form.get('sample_rate', 0)), mode=request.form.get('mode'),
+                                   route_filter=request.form.get('route_filter', ''))
+                flash('Profiler settings updated', 'success')
+            except ValueError:
+                flash('Sample rate must be a number between 0 and 1', 'error')
+        return redirect(url_for('profiler_admin'))
+    summary = profiler.summary()
+    if request.args.get('format') == 'json':
+        return jsonify(dict(summary, success=True))
+    return render_template('profiler.html', summary=summary)
+
+@app.route('/admin/profiler/<int:profile_id>.txt')
+@admin_required
+def profiler_download(profile_id):
+    profile = profiler.get_profile(profile_id)
+    if not profile:
+        flash('Profile not found', 'error')
+        return redirect(url_for('profiler_admin'))
+    body = profile['text'] if profile['mode'] == 'cprofile' else collapsed_text(profile['stacks'])
+    return app.response_class(body, mimetype='text/plain',
+                              headers={'Content-Disposition': f'attachment; filename=profile_{profile_id}_{profile["mode"]}.txt'})
+
+@app.route('/admin/profiler/route.txt')
+@admin_required
+def profiler_route_download():
+    route = request.args.get('route', '')
+    stacks = profiler.route_stacks(route)
+    if stacks is None:
+        flash('No samples for that route', 'error')
+        return redirect(url_for('profiler_admin'))
+    name = secure_filename(route.strip('/').replace('/', '_')) or 'root'
+    return app.response_class(collapsed_text(stacks), mimetype='text/plain',
+                              headers={'Content-Disposition': f'attachment; filename=route_{name}.collapsed.txt'})
+
 @app.route('/delete_user/<int:user_id>')
 @admin_required
 def delete_user_route(user_id):
@@ -246,6 +414,7 @@ def delete_material_route(material_id):
                 rag.bm25 = None
                 rag.nn = None
                 rag.embeddings = None
+                rag.chunk_lookup = {}
             flash(f'Material "{filename}" deleted successfully', 'success')
         else:
             flash('Error deleting material', 'error')
@@ -274,20 +443,26 @@ def chat():
             try:
                 import time
                 start_time = time.time()
-                ans, srcs = rag.query(q, top_k=3)
+                chat_store = get_chat_store()
+                conversation = chat_store.conversation(chat_session_id(session))
+                ans, srcs = rag.query(q, top_k=3, conversation=conversation)
                 response_time = time.time() - start_time
                 
                 avg_confidence = sum(s.get('score', 0) for s in srcs) / len(srcs) if srcs else 0
-                source_data = [{'chunk': s.get('chunk', ''), 'score': s.get('score', 0), 'metadata': s.get('metadata', {})} for s in srcs]
                 
-                log_qa(session['user_id'], q, ans, response_time, source_data, avg_confidence)
+                get_log_writer().enqueue('qa_log', {
+                    'user_id': session['user_id'],
+                    'question': q,
+                    'answer': ans,
+                    'response_time': response_time,
+                    'source_chunks': [chunk_ref(s) for s in srcs],
+                    'confidence_score': avg_confidence,
+                    'stage_timings': rag.last_timings(),
+                    'timestamp': utc_timestamp()
+                })
                 
-                if 'chat_history' not in session:
-                    session['chat_history'] = []
-                session['chat_history'].append({'question': q, 'answer': ans, 'sources': srcs, 'confidence': avg_confidence})
-                if len(session['chat_history']) > 10:
-                    session['chat_history'] = session['chat_history'][-10:]
-                session.modified = True
+                chat_store.append(chat_session_id(session), session['user_id'], q, ans, srcs, avg_confidence,
+                                  summary=rag.update_summary(conversation['summary'], q, ans))
                 if ajax:
                     return jsonify({
                         'success': True,
@@ -304,9 +479,36 @@ def chat():
         else:
             if ajax:
                 return jsonify({'success': False, 'error': 'Empty question'})
-    history = session.get('chat_history', [])
+    if 'chat_history' in session:
+        session.pop('chat_history')
+    history = []
+    if 'chat_sid' in session:
+        for turn in get_chat_store().history(session['chat_sid']):
+            history.append({'question': turn['question'], 'answer': turn['answer'], 'sources': rag.resolve_chunk_refs(turn['source_chunks']), 'confidence': turn['confidence']})
     return render_template('chat.html', chat_history=history)
 
+def format_timestamp(timestamp):
+    if not timestamp:
+        return ''
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    return str(timestamp)
+
+def chat_room(user_id, other_user_id):
+    return f'chat_{min(int(user_id), int(other_user_id))}_{max(int(user_id), int(other_user_id))}'
+
+def chat_message_payload(msg, from_name, to_name):
+    return {
+        'id': msg['id'],
+        'from_id': msg['from_id'],
+        'to_id': msg['to_id'],
+        'message': msg['message'],
+        'timestamp': format_timestamp(msg['timestamp']),
+        'from_name': from_name,
+        'to_name': to_name,
+        'client_id': msg.get('client_msg_id')
+    }
+
 @app.route('/chat_teacher', methods=['GET', 'POST'])
 @login_required
 def chat_teacher():
@@ -314,14 +516,6 @@ def chat_teacher():
     if user['role'] == 'admin':
         flash('Admins cannot use chat', 'error')
         return redirect(url_for('admin'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if user['role'] == 'student':
-        cursor.execute('SELECT DISTINCT u.id, u.username FROM users u JOIN user_subjects us1 ON u.id = us1.user_id JOIN user_subjects us2 ON us1.subject_id = us2.subject_id WHERE u.role = "teacher" AND us2.user_id = ?', (user['id'],))
-    else:
-        cursor.execute('SELECT DISTINCT u.id, u.username FROM users u JOIN user_subjects us1 ON u.id = us1.user_id JOIN user_subjects us2 ON us1.subject_id = us2.subject_id WHERE u.role = "student" AND us2.user_id = ?', (user['id'],))
-    teachers = cursor.fetchall()
-    conn.close()
     
     is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
     
@@ -330,52 +524,18 @@ def chat_teacher():
         message = request.form.get('message', '').strip()
         if teacher_id and message:
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('INSERT INTO teacher_chat (from_id, to_id, message) VALUES (?, ?, ?)', (user['id'], teacher_id, message))
-                message_id = cursor.lastrowid
-                cursor.execute('SELECT tc.*, u1.username as from_name, u2.username as to_name FROM teacher_chat tc JOIN users u1 ON tc.from_id = u1.id JOIN users u2 ON tc.to_id = u2.id WHERE tc.id = ?', (message_id,))
-                msg_data = cursor.fetchone()
-                conn.commit()
-                conn.close()
-                
-                # Format timestamp - handle both string and datetime objects
-                timestamp = msg_data[4]
-                if timestamp:
-                    if isinstance(timestamp, datetime):
-                        timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                    elif isinstance(timestamp, str):
-                        timestamp_str = timestamp
-                    else:
-                        timestamp_str = str(timestamp)
-                else:
-                    timestamp_str = ''
+                msg_data = add_chat_message(user['id'], int(teacher_id), message, request.form.get('client_id') or None)
+                if not msg_data:
+                    raise ValueError('Could not save message')
+                to_user = get_user_by_id(int(teacher_id))
+                payload = chat_message_payload(msg_data, user['username'], to_user['username'] if to_user else '')
                 
                 # Emit WebSocket event for real-time messaging
-                room_name = f'chat_{min(int(user["id"]), int(teacher_id))}_{max(int(user["id"]), int(teacher_id))}'
-                socketio.emit('new_message', {
-                    'id': msg_data[0],
-                    'from_id': msg_data[1],
-                    'to_id': msg_data[2],
-                    'message': msg_data[3],
-                    'timestamp': timestamp_str,
-                    'from_name': msg_data[5],
-                    'to_name': msg_data[6]
-                }, room=room_name)
+                chat_emitter.add(chat_room(user['id'], teacher_id), payload)
+                presence.message_sent(msg_data)
                 
                 if is_ajax:
-                    return jsonify({
-                        'success': True,
-                        'message': {
-                            'id': msg_data[0],
-                            'from_id': msg_data[1],
-                            'to_id': msg_data[2],
-                            'message': msg_data[3],
-                            'timestamp': timestamp_str,
-                            'from_name': msg_data[5],
-                            'to_name': msg_data[6]
-                        }
-                    })
+                    return jsonify({'success': True, 'message': payload})
                 flash('Message sent', 'success')
             except Exception as e:
                 if is_ajax:
@@ -388,63 +548,35 @@ def chat_teacher():
             return jsonify({'success': False, 'error': 'Invalid request'})
         return redirect(url_for('chat_teacher'))
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if user['role'] == 'student':
-        cursor.execute('SELECT tc.*, u1.username as from_name, u2.username as to_name FROM teacher_chat tc JOIN users u1 ON tc.from_id = u1.id JOIN users u2 ON tc.to_id = u2.id WHERE tc.from_id = ? OR tc.to_id = ? ORDER BY tc.timestamp DESC LIMIT 50', (user['id'], user['id']))
-    else:
-        cursor.execute('SELECT tc.*, u1.username as from_name, u2.username as to_name FROM teacher_chat tc JOIN users u1 ON tc.from_id = u1.id JOIN users u2 ON tc.to_id = u2.id WHERE tc.from_id = ? OR tc.to_id = ? ORDER BY tc.timestamp DESC LIMIT 50', (user['id'], user['id']))
-    messages = cursor.fetchall()
-    conn.close()
-    return render_template('chat_teacher.html', teachers=teachers, messages=messages, user=user)
+    teachers = get_chat_contacts(user['id'], user['role'])
+    return render_template('chat_teacher.html', teachers=teachers, user=user)
 
 @app.route('/chat_teacher/api/messages')
 @login_required
 def get_chat_messages():
     user = get_current_user()
     other_user_id = request.args.get('other_user_id', type=int)
+    since_id = request.args.get('since_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
     
     if not other_user_id:
         return jsonify({'success': False, 'error': 'Missing other_user_id'})
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT tc.*, u1.username as from_name, u2.username as to_name 
-        FROM teacher_chat tc 
-        JOIN users u1 ON tc.from_id = u1.id 
-        JOIN users u2 ON tc.to_id = u2.id 
-        WHERE (tc.from_id = ? AND tc.to_id = ?) OR (tc.from_id = ? AND tc.to_id = ?)
-        ORDER BY tc.timestamp ASC
-        LIMIT 100
-    ''', (user['id'], other_user_id, other_user_id, user['id']))
-    rows = cursor.fetchall()
-    conn.close()
+    latest_id = get_chat_latest_id(user['id'], other_user_id)
+    etag = f'{min(user["id"], other_user_id)}-{max(user["id"], other_user_id)}-{latest_id}-{since_id}-{before_id}-{limit}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
     
-    messages = []
-    for row in rows:
-        timestamp = row[4]
-        if timestamp:
-            if isinstance(timestamp, datetime):
-                timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            elif isinstance(timestamp, str):
-                timestamp_str = timestamp
-            else:
-                timestamp_str = str(timestamp)
-        else:
-            timestamp_str = ''
-        
-        messages.append({
-            'id': row[0],
-            'from_id': row[1],
-            'to_id': row[2],
-            'message': row[3],
-            'timestamp': timestamp_str,
-            'from_name': row[5],
-            'to_name': row[6]
-        })
+    rows = get_conversation_messages(user['id'], other_user_id, since_id=since_id, before_id=before_id, limit=limit)
+    messages = [chat_message_payload(row, row['from_name'], row['to_name']) for row in rows]
     
-    return jsonify({'success': True, 'messages': messages})
+    response = jsonify({'success': True, 'messages': messages, 'latest_id': latest_id, 'has_more': since_id is None and len(messages) == limit})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/create_quiz', methods=['GET', 'POST'])
 @teacher_required
@@ -456,7 +588,7 @@ def create_quiz_route():
         num_q = int(request.form.get('num_questions', 5))
         try:
             rag = get_rag_system()
-            qs = rag.generate_quiz(num_q, desc, sid)
+            qs = rag.generate_quiz(num_q, desc, sid, subject_index=get_subject_index(sid))
             if qs:
                 qid = create_quiz(title, sid, session['user_id'], qs)
                 flash(f'Quiz "{title}" created!', 'success')
@@ -468,10 +600,47 @@ def create_quiz_route():
     teacher_subs = get_user_subjects(session['user_id'])
     return render_template('create_quiz.html', subjects=teacher_subs)
 
+@app.route('/create_quiz/stream', methods=['POST'])
+@teacher_required
+def create_quiz_stream():
+    title = request.form['title']
+    sid = request.form['subject_id']
+    desc = request.form['description']
+    num_q = int(request.form.get('num_questions', 5))
+    teacher_id = session['user_id']
+    redirect_url = url_for('my_quizzes')
+    rag = get_rag_system()
+    
+    def generate():
+        qs = []
+        qid = None
+        try:
+            questions = rag.iter_quiz_questions(num_q, desc, sid, subject_index=get_subject_index(sid))
+            for q in questions:
+                qs.append(q)
+                yield json.dumps({'type': 'question', 'index': len(qs), 'total': num_q, 'question': q}) + '\n'
+            if qs:
+                qid = create_quiz(title, sid, teacher_id, qs)
+                yield json.dumps({'type': 'done', 'quiz_id': qid, 'count': len(qs), 'redirect': redirect_url}) + '\n'
+            else:
+                yield json.dumps({'type': 'error', 'error': 'Failed to generate quiz'}) + '\n'
+        except GeneratorExit:
+            questions.close()
+            if qs and qid is None:
+                create_quiz(title, sid, teacher_id, qs)
+            raise
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+    
+    response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/assign_quiz/<int:quiz_id>', methods=['GET', 'POST'])
 @teacher_required
 def assign_quiz(quiz_id):
-    quiz = get_quiz_by_id(quiz_id)
+    quiz = get_quiz_by_id(quiz_id, include_questions=False)
     if not quiz or quiz['teacher_id'] != session['user_id']:
         flash('Quiz not found', 'error')
         return redirect(url_for('my_quizzes'))
@@ -489,9 +658,9 @@ def assign_quiz(quiz_id):
     assigned = set(row[0] for row in cursor.fetchall())
     quiz_subject_id = quiz.get('subject_id')
     if quiz_subject_id:
-        cursor.execute('SELECT DISTINCT u.id, u.username FROM users u JOIN user_subjects us ON u.id = us.user_id WHERE u.role = "student" AND us.subject_id = ?', (quiz_subject_id,))
+        cursor.execute("SELECT DISTINCT u.id, u.username FROM users u JOIN user_subjects us ON u.id = us.user_id WHERE u.role = 'student' AND us.subject_id = ?", (quiz_subject_id,))
     else:
-        cursor.execute('SELECT id, username FROM users WHERE role = "student"')
+        cursor.execute("SELECT id, username FROM users WHERE role = 'student'")
     students = []
     for row in cursor.fetchall():
         students.append({'id': row[0], 'username': row[1], 'assigned': row[0] in assigned})
@@ -521,8 +690,6 @@ def edit_quiz(quiz_id):
     if request.method == 'POST':
         action = request.form.get('action')
         try:
-            questions = quiz['questions'] if isinstance(quiz['questions'], list) else json.loads(quiz['questions'])
-            
             if action == 'add':
                 question_text = request.form.get('question', '').strip()
                 option_a = request.form.get('option_a', '').strip()
@@ -538,20 +705,17 @@ def edit_quiz(quiz_id):
                         'correct': correct,
                         'type': 'multiple_choice'
                     }
-                    questions.append(new_question)
-                    update_quiz_questions(quiz_id, questions)
+                    add_quiz_question(quiz_id, new_question)
                     flash('Question added successfully', 'success')
                 else:
                     flash('Invalid question data', 'error')
             
             elif action == 'delete':
-                question_index = int(request.form.get('question_index'))
-                if 0 <= question_index < len(questions):
-                    questions.pop(question_index)
-                    update_quiz_questions(quiz_id, questions)
+                question_id = int(request.form.get('question_id'))
+                if delete_quiz_question(quiz_id, question_id):
                     flash('Question deleted successfully', 'success')
                 else:
-                    flash('Invalid question index', 'error')
+                    flash('Invalid question', 'error')
             
             elif action == 'generate':
                 num_q = int(request.form.get('num_questions', 1))
@@ -559,11 +723,10 @@ def edit_quiz(quiz_id):
                 sid = quiz.get('subject_id')
                 try:
                     rag = get_rag_system()
-                    existing_questions = questions
-                    new_qs = rag.generate_quiz(num_q, desc, sid, difficulty="medium", existing_questions=existing_questions)
+                    existing_questions = quiz['questions']
+                    new_qs = rag.generate_quiz(num_q, desc, sid, difficulty="medium", existing_questions=existing_questions, subject_index=get_subject_index(sid))
                     if new_qs:
-                        questions.extend(new_qs)
-                        update_quiz_questions(quiz_id, questions)
+                        add_quiz_questions(quiz_id, new_qs)
                         flash(f'{len(new_qs)} question(s) generated successfully', 'success')
                     else:
                         flash('Failed to generate questions', 'error')
@@ -574,8 +737,29 @@ def edit_quiz(quiz_id):
         except Exception as e:
             flash(f'Error: {str(e)}', 'error')
     
-    questions = quiz['questions'] if isinstance(quiz['questions'], list) else json.loads(quiz['questions'])
-    return render_template('edit_quiz.html', quiz=quiz, questions=questions, assigned_count=assigned_count)
+    return render_template('edit_quiz.html', quiz=quiz, questions=quiz['questions'], assigned_count=assigned_count)
+
+@app.route('/quiz_stats/<int:quiz_id>')
+@teacher_required
+def quiz_stats(quiz_id):
+    quiz = get_quiz_by_id(quiz_id, include_questions=False)
+    if not quiz or quiz['teacher_id'] != session['user_id']:
+        flash('Quiz not found', 'error')
+        return redirect(url_for('my_quizzes'))
+    questions = get_quiz_stats(quiz_id)
+    mastery = get_subject_mastery(quiz['subject_id']) if quiz.get('subject_id') else []
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'quiz': quiz, 'questions': questions, 'mastery': mastery})
+    return render_template('quiz_stats.html', quiz=quiz, questions=questions, mastery=mastery)
+
+@app.route('/question_bank')
+@teacher_required
+def question_bank_stats():
+    subjects = get_user_subjects(session['user_id'])
+    stats = get_question_bank_stats([s['id'] for s in subjects])
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'subjects': stats})
+    return render_template('question_bank.html', stats=stats)
 
 @app.route('/student_quizzes')
 @login_required
@@ -585,18 +769,9 @@ def student_quizzes():
         flash('Access denied', 'error')
         return redirect(url_for('index'))
     quizzes = get_student_quizzes(user['id'])
-    conn = get_db_connection()
-    cursor = conn.cursor()
     for quiz in quizzes:
-        cursor.execute('SELECT id, score, time FROM quiz_results WHERE user_id = ? AND quiz_id = ? ORDER BY time DESC LIMIT 1', (user['id'], quiz['id']))
-        result = cursor.fetchone()
-        if result:
-            quiz['completed_time'] = result[2]
-            quiz['score'] = round(result[1], 1)
-        else:
-            quiz['completed_time'] = None
-            quiz['score'] = None
-    conn.close()
+        if quiz['score'] is not None:
+            quiz['score'] = round(quiz['score'], 1)
     return render_template('student_quizzes.html', quizzes=quizzes)
 
 @app.route('/take_quiz/<int:quiz_id>', methods=['GET', 'POST'])
@@ -606,22 +781,14 @@ def take_quiz(quiz_id):
     if user['role'] != 'student':
         flash('Access denied', 'error')
         return redirect(url_for('index'))
+    if get_quiz_status(user['id'], quiz_id):
+        flash('You already completed this quiz', 'info')
+        return redirect(url_for('student_quizzes'))
     quiz = get_quiz_by_id(quiz_id)
     if not quiz:
         flash('Quiz not found', 'error')
         return redirect(url_for('student_quizzes'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM quiz_results WHERE user_id = ? AND quiz_id = ?', (user['id'], quiz_id))
-    if cursor.fetchone():
-        flash('You already completed this quiz', 'info')
-        conn.close()
-        return redirect(url_for('student_quizzes'))
-    conn.close()
-    try:
-        qs = json.loads(quiz['questions']) if isinstance(quiz['questions'], str) else quiz['questions']
-    except:
-        qs = quiz['questions']
+    qs = quiz['questions']
     if request.method == 'POST':
         ans = []
         correct = 0
@@ -631,9 +798,9 @@ def take_quiz(quiz_id):
             corr_ans = q['correct'].strip().upper()
             if u_ans == corr_ans:
                 correct += 1
-            ans.append({'question': q['question'], 'user_answer': u_ans, 'correct_answer': corr_ans, 'is_correct': u_ans == corr_ans})
+            ans.append({'question_id': q['id'], 'question': q['question'], 'user_answer': u_ans, 'correct_answer': corr_ans, 'is_correct': u_ans == corr_ans})
         score = (correct / len(qs)) * 100
-        log_quiz_result(user['id'], score, ans, quiz_id)
+        get_log_writer().enqueue('quiz_result', {'user_id': user['id'], 'quiz_id': quiz_id, 'score': score, 'answers': ans, 'time': utc_timestamp()}, wait=True)
         return redirect(url_for('student_quizzes'))
     return render_template('take_quiz.html', quiz=quiz, questions=qs)
 
@@ -722,12 +889,14 @@ def profile():
 @admin_required
 def query_history():
     logs = get_qa_logs()
+    rag = get_rag_system()
     conn = get_db_connection()
     cursor = conn.cursor()
     for log in logs:
         cursor.execute('SELECT username FROM users WHERE id = ?', (log['user_id'],))
         user_row = cursor.fetchone()
         log['username'] = user_row[0] if user_row else 'Unknown'
+        log['source_chunks'] = rag.resolve_chunk_refs(log['source_chunks'])
         log['corrections'] = get_qa_corrections(log['id'])
     conn.close()
     return render_template('query_history.html', logs=logs)
@@ -761,6 +930,7 @@ def correct_answer(qa_log_id):
                         from sklearn.neighbors import NearestNeighbors
                         rag.nn = NearestNeighbors(n_neighbors=k_value, metric='cosine')
                         rag.nn.fit(rag.embeddings)
+                        rag._index_subjects()
                     flash('Correction added and indexed successfully', 'success')
             except Exception as e:
                 flash(f'Error indexing correction: {str(e)}', 'error')
@@ -770,34 +940,93 @@ def correct_answer(qa_log_id):
         flash('Please provide a corrected answer', 'error')
     return redirect(request.referrer or url_for('query_history'))
 
+socket_users = {}
+
 @socketio.on('connect')
 def handle_connect():
-    print('Client connected')
+    if 'user_id' not in session or session.get('role') == 'admin':
+        return False
+    contacts = get_chat_contacts(session['user_id'], session.get('role'))
+    socket_users[request.sid] = {
+        'id': session['user_id'],
+        'username': session.get('username'),
+        'contacts': {c['id']: c['username'] for c in contacts}
+    }
+    join_room(user_room(session['user_id']))
+    socket_connections.inc()
+    emit('presence_state', presence.connect(request.sid, session['user_id'], list(socket_users[request.sid]['contacts'])))
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print('Client disconnected')
+    sock_user = socket_users.pop(request.sid, None)
+    if sock_user:
+        socket_connections.dec()
+        presence.disconnect(request.sid, sock_user['id'], list(sock_user['contacts']))
 
 @socketio.on('join_room')
 def handle_join_room(data):
-    user_id = data.get('user_id')
+    sock_user = socket_users.get(request.sid)
     other_user_id = data.get('other_user_id')
-    if user_id and other_user_id:
-        room_name = f'chat_{min(int(user_id), int(other_user_id))}_{max(int(user_id), int(other_user_id))}'
-        join_room(room_name)
-        print(f'User {user_id} joined room {room_name}')
+    if sock_user and other_user_id and int(other_user_id) in sock_user['contacts']:
+        join_room(chat_room(sock_user['id'], other_user_id))
+        presence.mark_read(sock_user['id'], int(other_user_id), get_chat_latest_id(sock_user['id'], int(other_user_id)))
 
 @socketio.on('leave_room')
 def handle_leave_room(data):
-    user_id = data.get('user_id')
+    sock_user = socket_users.get(request.sid)
     other_user_id = data.get('other_user_id')
-    if user_id and other_user_id:
-        room_name = f'chat_{min(int(user_id), int(other_user_id))}_{max(int(user_id), int(other_user_id))}'
-        leave_room(room_name)
-        print(f'User {user_id} left room {room_name}')
+    if sock_user and other_user_id:
+        leave_room(chat_room(sock_user['id'], other_user_id))
+
+@socketio.on('mark_read')
+def handle_mark_read(data):
+    sock_user = socket_users.get(request.sid)
+    try:
+        other_id = int(data.get('other_user_id'))
+        message_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
+        return
+    if sock_user and other_id in sock_user['contacts']:
+        presence.mark_read(sock_user['id'], other_id, message_id)
+
+@socketio.on('typing')
+def handle_typing(data):
+    sock_user = socket_users.get(request.sid)
+    try:
+        to_id = int(data.get('to_id'))
+    except (TypeError, ValueError):
+        return
+    if sock_user and to_id in sock_user['contacts']:
+        presence.typing(sock_user['id'], to_id, data.get('typing'))
+
+@socketio.on('send_message')
+def handle_send_message(data):
+    sock_user = socket_users.get(request.sid)
+    if not sock_user:
+        return {'success': False, 'error': 'Not logged in'}
+    try:
+        to_id = int(data.get('to_id'))
+    except (TypeError, ValueError):
+        return {'success': False, 'error': 'Missing to_id'}
+    message = str(data.get('message', '')).strip()
+    client_id = data.get('client_id') or None
+    if not message:
+        return {'success': False, 'error': 'Empty message', 'client_id': client_id}
+    if to_id not in sock_user['contacts']:
+        return {'success': False, 'error': 'Access denied', 'client_id': client_id}
+    msg_data = add_chat_message(sock_user['id'], to_id, message, client_id)
+    if not msg_data:
+        socket_messages.inc('error')
+        return {'success': False, 'error': 'Could not save message', 'client_id': client_id}
+    socket_messages.inc('ok')
+    payload = chat_message_payload(msg_data, sock_user['username'], sock_user['contacts'][to_id])
+    chat_emitter.add(chat_room(sock_user['id'], to_id), payload)
+    presence.message_sent(msg_data)
+    return {'success': True, 'client_id': client_id, 'message': payload}
 
 if __name__ == '__main__':
     init_db()
+    get_log_writer()
     get_rag_system()
     port = int(os.environ.get('PORT', 2121))
     socketio.run(app, debug=True, host='0.0.0.0', port=port)
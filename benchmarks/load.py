@@ -0,0 +1,332 @@
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import numpy as np
+
+from benchmarks.retrieval import synthetic_corpus
+
+PASSWORD = 'loadtest'
+STUDENT_ACTIONS = {'chat': 4, 'student_quizzes': 2, 'take_quiz': 2, 'chat_teacher': 1, 'messages': 2, 'socket_send': 2}
+TEACHER_ACTIONS = {'messages': 3, 'chat_teacher': 1, 'my_quizzes': 1, 'quiz_stats': 1, 'question_bank': 1, 'socket_send': 2}
+
+def seed(manifest_path, students, teachers, quizzes, docs):
+    from database.db import (init_db, add_user, add_subject, assign_user_subjects, add_material, create_quiz,
+                             assign_quiz_to_students)
+    init_db()
+    subject_id = add_subject('Load Test')
+    teacher_ids = [add_user(f'lt_teacher{i}', PASSWORD, 'teacher') for i in range(teachers)]
+    student_ids = [add_user(f'lt_student{i}', PASSWORD, 'student') for i in range(students)]
+    assign_user_subjects([(user_id, subject_id) for user_id in teacher_ids + student_ids])
+    materials, queries = synthetic_corpus(num_docs=docs, words_per_doc=600)
+    for m in materials:
+        add_material(m['filename'], m['content'], subject_id, indexed=1)
+    quiz_ids, quiz_owners = [], {}
+    for n in range(max(quizzes, len(teacher_ids))):
+        questions = [{'question': f'Load question {n}.{i}', 'options': ['one', 'two', 'three', 'four'], 'correct': 'ABCD'[i % 4]}
+                     for i in range(5)]
+        quiz_id = create_quiz(f'Load quiz {n}', subject_id, teacher_ids[n % len(teacher_ids)], questions)
+        assign_quiz_to_students(quiz_id, student_ids)
+        quiz_ids.append(quiz_id)
+        quiz_owners.setdefault(teacher_ids[n % len(teacher_ids)], []).append(quiz_id)
+    return {'students': [{'id': i, 'username': f'lt_student{n}'} for n, i in enumerate(student_ids)],
+            'teachers': [{'id': i, 'username': f'lt_teacher{n}'} for n, i in enumerate(teacher_ids)],
+            'quiz_ids': quiz_ids, 'quiz_owners': {str(k): v for k, v in quiz_owners.items()}, 'questions': [q['query'] for q in queries]}
+
+def serve(args):
+    manifest = seed(args.manifest, args.students, args.teachers, args.quizzes, args.docs)
+    import app as appmod
+    from services.log_writer import get_log_writer
+    from services.rag_service import get_rag_system
+    get_log_writer()
+    rag = get_rag_system()
+    rag.delay = args.rag_delay
+    rag.client.latency = args.llm_latency
+    with open(args.manifest + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(args.manifest + '.tmp', args.manifest)
+    appmod.socketio.run(appmod.app, host='127.0.0.1', port=args.port, allow_unsafe_werkzeug=True)
+
+class Stats:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds * 1000)
+            self.errors[name] = self.errors.get(name, 0) + (0 if ok else 1)
+
+    def summary(self, elapsed):
+        report = {}
+        with self.lock:
+            for name, samples in sorted(self.samples.items()):
+                p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+                report[name] = {'requests': len(samples), 'rps': len(samples) / elapsed,
+                                'error_rate': self.errors[name] / len(samples),
+                                'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': max(samples)}
+        return report
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+class VirtualUser:
+    def __init__(self, base_url, user, role, manifest, stats, socket_enabled, timeout=30):
+        self.base_url = base_url
+        self.user = user
+        self.role = role
+        self.manifest = manifest
+        self.stats = stats
+        self.timeout = timeout
+        self.jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar), NoRedirect)
+        self.random = random.Random(user['id'])
+        self.contacts = manifest['teachers'] if role == 'student' else manifest['students']
+        self.pending_quizzes = list(manifest['quiz_ids']) if role == 'student' else []
+        self.own_quizzes = manifest['quiz_owners'].get(str(user['id']), [])
+        self.socket_enabled = socket_enabled
+        self.sio = None
+        self.sent = {}
+
+    def request(self, name, path, data=None, ajax=False, expect_redirect=False):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        headers = {'X-Requested-With': 'XMLHttpRequest'} if ajax else {}
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers)
+        start = time.perf_counter()
+        payload, status = b'', None
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                payload, status = resp.read(), resp.status
+        except urllib.error.HTTPError as e:
+            payload, status = e.read(), e.code
+        except OSError:
+            pass
+        ok = status is not None and (status < 300 or (expect_redirect and 300 <= status < 400))
+        if ok and ajax:
+            try:
+                ok = json.loads(payload).get('success', True)
+            except ValueError:
+                ok = False
+        self.stats.record(name, time.perf_counter() - start, ok)
+        return status, payload
+
+    def login(self):
+        status, _ = self.request('POST /login', '/login', {'username': self.user['username'], 'password': PASSWORD}, expect_redirect=True)
+        return status == 302
+
+    def connect_socket(self):
+        import socketio
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('new_messages', self.on_messages)
+        cookie = '; '.join(f'{c.name}={c.value}' for c in self.jar)
+        start = time.perf_counter()
+        try:
+            self.sio.connect(self.base_url, headers={'Cookie': cookie}, wait_timeout=self.timeout)
+        except Exception:
+            self.stats.record('socket connect', time.perf_counter() - start, False)
+            self.sio = None
+            return
+        self.stats.record('socket connect', time.perf_counter() - start, True)
+        for contact in self.contacts:
+            self.sio.emit('join_room', {'other_user_id': contact['id']})
+
+    def on_messages(self, payloads):
+        now = time.perf_counter()
+        for payload in payloads:
+            sent = self.sent.pop(payload.get('client_id'), None) if payload.get('from_id') != self.user['id'] else None
+            if sent is not None:
+                self.stats.record('socket delivery', now - sent, True)
+
+    def act(self, action, registry):
+        contact = self.random.choice(self.contacts)
+        if action == 'chat':
+            self.request('POST /chat', '/chat', {'question': self.random.choice(self.manifest['questions'])}, ajax=True)
+        elif action == 'take_quiz':
+            if not self.pending_quizzes:
+                return
+            quiz_id = self.pending_quizzes.pop()
+            self.request('GET /take_quiz/<id>', f'/take_quiz/{quiz_id}')
+            self.request('POST /take_quiz/<id>', f'/take_quiz/{quiz_id}', {f'q{i}': self.random.choice('ABCD') for i in range(5)},
+                         expect_redirect=True)
+        elif action == 'chat_teacher':
+            self.request('POST /chat_teacher', '/chat_teacher',
+                         {'teacher_id': contact['id'], 'message': 'load test message', 'client_id': uuid.uuid4().hex}, ajax=True)
+        elif action == 'messages':
+            self.request('GET /chat_teacher/api/messages', f"/chat_teacher/api/messages?other_user_id={contact['id']}&limit=50")
+        elif action == 'quiz_stats':
+            if self.own_quizzes:
+                self.request('GET /quiz_stats/<id>', f'/quiz_stats/{self.random.choice(self.own_quizzes)}')
+        elif action == 'socket_send':
+            if self.sio is None:
+                return
+            client_id = uuid.uuid4().hex
+            start = time.perf_counter()
+            for other in registry.get(contact['id'], ()):
+                other.sent[client_id] = start
+            try:
+                ack = self.sio.call('send_message', {'to_id': contact['id'], 'message': 'load test socket message',
+                                                     'client_id': client_id}, timeout=self.timeout)
+                ok = bool(ack and ack.get('success'))
+            except Exception:
+                ok = False
+            self.stats.record('socket send_message', time.perf_counter() - start, ok)
+        else:
+            self.request(f'GET /{action}', f'/{action}')
+
+    def run(self, deadline, think_time, registry):
+        actions = STUDENT_ACTIONS if self.role == 'student' else TEACHER_ACTIONS
+        names, weights = list(actions), list(actions.values())
+        if not self.socket_enabled:
+            weights[names.index('socket_send')] = 0
+        while time.time() < deadline:
+            self.act(self.random.choices(names, weights=weights)[0], registry)
+            if think_time:
+                time.sleep(self.random.uniform(0, 2 * think_time))
+        if self.sio is not None:
+            self.sio.disconnect()
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(args, workdir):
+    port = _free_port()
+    manifest_path = os.path.join(workdir, 'manifest.json')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'load.db')}", LLM_CLIENT='fake')
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    cmd = [sys.executable, '-m', 'benchmarks.load', '--serve', '--port', str(port), '--manifest', manifest_path,
+           '--students', str(args.students), '--teachers', str(args.teachers), '--quizzes', str(args.quizzes),
+           '--docs', str(args.docs), '--llm-latency', str(args.llm_latency), '--rag-delay', str(args.rag_delay)]
+    proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline and proc.poll() is None:
+        if os.path.exists(manifest_path):
+            try:
+                urllib.request.urlopen(base_url + '/login', timeout=2).read()
+                with open(manifest_path, encoding='utf-8') as f:
+                    return proc, base_url, json.load(f)
+            except OSError:
+                pass
+        time.sleep(0.2)
+    proc.kill()
+    log.close()
+    with open(os.path.join(workdir, 'server.log'), encoding='utf-8') as f:
+        raise RuntimeError('server did not start:\n' + f.read()[-2000:])
+
+def socket_client_available():
+    try:
+        import requests, websocket, socketio  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    proc = None
+    try:
+        proc, base_url, manifest = start_server(args, workdir)
+        socket_enabled = args.socket and socket_client_available()
+        stats = Stats()
+        users = ([VirtualUser(base_url, u, 'student', manifest, stats, socket_enabled) for u in manifest['students']] +
+                 [VirtualUser(base_url, u, 'teacher', manifest, stats, socket_enabled) for u in manifest['teachers']])
+        registry = {}
+        for user in users:
+            if user.login() and socket_enabled:
+                user.connect_socket()
+            registry.setdefault(user.user['id'], []).append(user)
+        start = time.time()
+        threads = [threading.Thread(target=user.run, args=(start + args.duration, args.think_time, registry), daemon=True)
+                   for user in users]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report = stats.summary(time.time() - start)
+        notes = [] if socket_enabled or not args.socket else ['socket workload skipped: install python-socketio[client]']
+        return report, notes
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def format_report(report):
+    header = ['endpoint', 'requests', 'rps', 'errors%', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    lines = [f'{header[0]:<32}' + ''.join(f'{h:>10}' for h in header[1:])]
+    for name, r in report.items():
+        lines.append(f'{name:<32}{r["requests"]:>10}{r["rps"]:>10.1f}{r["error_rate"] * 100:>10.1f}'
+                     f'{r["p50_ms"]:>10.1f}{r["p95_ms"]:>10.1f}{r["p99_ms"]:>10.1f}{r["max_ms"]:>10.1f}')
+    return '\n'.join(lines)
+
+def compare(report, baseline, max_regression, max_error_rate):
+    failures = []
+    for name, r in report.items():
+        if r['error_rate'] > max_error_rate:
+            failures.append(f'{name}: error rate {r["error_rate"]:.1%} > {max_error_rate:.1%}')
+        before = baseline.get(name)
+        if before and r['p95_ms'] > before['p95_ms'] * (1 + max_regression):
+            failures.append(f'{name}: p95 {r["p95_ms"]:.1f}ms vs baseline {before["p95_ms"]:.1f}ms')
+        if before and r['rps'] < before['rps'] * (1 - max_regression):
+            failures.append(f'{name}: {r["rps"]:.1f} rps vs baseline {before["rps"]:.1f} rps')
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test app.py against a temporary SQLite DB and a fake LLM')
+    parser.add_argument('--students', type=int, default=20)
+    parser.add_argument('--teachers', type=int, default=2)
+    parser.add_argument('--quizzes', type=int, default=20)
+    parser.add_argument('--docs', type=int, default=30)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean pause between actions per user')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='seconds per fake LLM call')
+    parser.add_argument('--rag-delay', type=float, default=0.0, help='SmartStudyRAG.rate_limit delay on the server')
+    parser.add_argument('--no-socket', dest='socket', action='store_false')
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--save', help='write the per-endpoint report as JSON')
+    parser.add_argument('--baseline', help='JSON report from a previous --save run to gate against')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--manifest', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+    report, notes = run(args)
+    print(format_report(report))
+    for note in notes:
+        print(note)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            failures = compare(report, json.load(f), args.max_regression, args.max_error_rate)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
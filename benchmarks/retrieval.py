@@ -0,0 +1,152 @@
+import argparse
+import hashlib
+import json
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+from database.db import get_corrected_questions, get_materials
+from services.fake_llm import FakeChatClient
+from services.rag import SmartStudyRAG
+from services.rerank import create_reranker
+
+ATTRIBUTES = ['capital', 'symbol', 'author', 'origin', 'purpose', 'formula', 'unit', 'founder']
+SYLLABLES = ['ka', 'lo', 'mi', 'ten', 'ra', 'vo', 'sul', 'pe', 'dri', 'no', 'zan', 'qua', 'bel', 'tor', 'ish', 'um']
+
+def _pseudo_words(count, rng, syllables=3):
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, syllables))))
+    return sorted(words)
+
+def synthetic_corpus(num_docs=100, words_per_doc=800, facts_per_doc=4, vocab_size=5000, seed=0):
+    rng = random.Random(seed)
+    vocab = _pseudo_words(vocab_size, rng, syllables=4)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+    entities = iter(_pseudo_words(num_docs * facts_per_doc * 2, random.Random(seed + 1), syllables=5))
+    materials, queries = [], []
+    for doc_id in range(1, num_docs + 1):
+        words = rng.choices(vocab, weights=weights, k=words_per_doc)
+        for pos in sorted(rng.sample(range(words_per_doc), facts_per_doc), reverse=True):
+            entity, value = next(entities), next(entities)
+            attribute = rng.choice(ATTRIBUTES)
+            fact = f'The {attribute} of {entity} is {value}.'
+            words[pos:pos] = fact.split()
+            question = rng.choice([f'What is the {attribute} of {entity}?', f'Explain the {attribute} of {entity}',
+                                   f'{entity} {attribute}'])
+            queries.append({'query': question, 'relevant': [fact], 'source': 'synthetic'})
+        materials.append({'id': doc_id, 'filename': f'doc_{doc_id}.txt', 'sha': hashlib.sha1(str(doc_id).encode()).hexdigest(),
+                          'content': ' '.join(words), 'subject_id': doc_id % 5 + 1, 'upload_time': None})
+    return materials, queries
+
+def correction_materials(start_id):
+    materials, queries = [], []
+    for offset, row in enumerate(get_corrected_questions()):
+        text = f"Question: {row['question']}\nCorrect Answer: {row['corrected_answer']}"
+        materials.append({'id': start_id + offset, 'filename': 'correction', 'sha': None, 'content': text,
+                          'subject_id': None, 'upload_time': None})
+        queries.append({'query': row['question'], 'relevant': [text], 'source': 'correction'})
+    return materials, queries
+
+def load_queries(path):
+    with open(path, encoding='utf-8') as f:
+        return [dict(json.loads(line), source='file') for line in f if line.strip()]
+
+def label_queries(rag, queries):
+    labeled = []
+    for q in queries:
+        snippets = [' '.join(s.split()) for s in q['relevant']]
+        relevant = {i for i, chunk in enumerate(rag.chunks) if any(s in chunk for s in snippets)}
+        if relevant:
+            labeled.append(dict(q, relevant_ids=relevant))
+    return labeled
+
+def build_index(materials, client):
+    rag = SmartStudyRAG('bench', client=client)
+    rag.delay = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    rag.rebuild_from_db(materials)
+    build_seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rag, {'build_seconds': build_seconds, 'build_peak_mb': peak / 2**20,
+                 'index_mb': (rag.embeddings.nbytes if rag.embeddings is not None else 0) / 2**20}
+
+def evaluate(rag, queries, ks=(1, 3, 5)):
+    max_k = max(ks)
+    hits = {k: 0 for k in ks}
+    reciprocal_ranks, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results = rag.search(q['query'], top_k=max_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ranked = [rag.chunk_lookup.get((r['metadata'].get('material_id'), r['metadata'].get('chunk_id'))) for r in results]
+        rank = next((pos for pos, idx in enumerate(ranked, 1) if idx in q['relevant_ids']), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        for k in ks:
+            hits[k] += 1 if rank and rank <= k else 0
+    count = len(queries) or 1
+    report = {f'recall@{k}': hits[k] / count for k in ks}
+    report['mrr'] = sum(reciprocal_ranks) / count
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+    report.update({'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'queries': len(queries)})
+    return report
+
+def run(args):
+    client = FakeChatClient(dim=args.dim, seed=args.seed)
+    if args.corpus == 'db':
+        materials, queries = get_materials(), []
+    else:
+        materials, queries = synthetic_corpus(args.docs, args.words, args.facts, seed=args.seed)
+    if args.queries_file:
+        queries += load_queries(args.queries_file)
+    if args.corrections:
+        extra, correction_queries = correction_materials(max([m['id'] for m in materials] or [0]) + 1)
+        materials += extra
+        queries += correction_queries
+    rag, build = build_index(materials, client)
+    queries = label_queries(rag, queries)
+    if args.max_queries:
+        queries = random.Random(args.seed).sample(queries, min(args.max_queries, len(queries)))
+    ks = [int(k) for k in args.k.split(',')]
+    lines = [f"corpus={args.corpus} materials={len(materials)} chunks={len(rag.chunks)} queries={len(queries)} "
+             f"build={build['build_seconds']:.2f}s build_peak={build['build_peak_mb']:.1f}MB embeddings={build['index_mb']:.1f}MB"]
+    header = ['alpha', 'rerank'] + [f'recall@{k}' for k in ks] + ['mrr', 'p50_ms', 'p95_ms', 'p99_ms']
+    lines.append('  '.join(f'{h:>10}' for h in header))
+    for alpha in [float(a) for a in args.alpha.split(',')]:
+        for mode in args.rerank.split(','):
+            rag.alpha = alpha
+            rag.reranker = create_reranker(rag, mode)
+            report = evaluate(rag, queries, ks)
+            row = [f'{alpha:>10.2f}', f'{mode:>10}'] + [f"{report[h]:>10.3f}" for h in header[2:]]
+            lines.append('  '.join(row))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline recall/MRR/latency benchmark for SmartStudyRAG.search')
+    parser.add_argument('--corpus', choices=['synthetic', 'db'], default='synthetic')
+    parser.add_argument('--docs', type=int, default=100)
+    parser.add_argument('--words', type=int, default=800)
+    parser.add_argument('--facts', type=int, default=4)
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queries-file', help='JSONL of {"query": ..., "relevant": [snippet, ...]}')
+    parser.add_argument('--no-corrections', dest='corrections', action='store_false',
+                        help='skip teacher corrections from qa_corrections')
+    parser.add_argument('--max-queries', type=int, default=0)
+    parser.add_argument('--k', default='1,3,5')
+    parser.add_argument('--alpha', default='0.7')
+    parser.add_argument('--rerank', default='off')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+    report = run(args)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+
+if __name__ == '__main__':
+    main()
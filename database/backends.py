@@ -0,0 +1,223 @@
+import queue
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+class ConnectionPool:
+    def __init__(self, factory, max_size=10):
+        self.factory = factory
+        self.idle = queue.LifoQueue(maxsize=max_size)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.factory()
+
+    def release(self, raw):
+        try:
+            raw.rollback()
+            self.idle.put_nowait(raw)
+        except Exception:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+            except Exception:
+                continue
+
+class PooledConnection:
+    def __init__(self, backend, raw):
+        self.backend = backend
+        self.raw = raw
+
+    def cursor(self):
+        return self.backend.wrap_cursor(self.raw)
+
+    def execute(self, sql, params=()):
+        cursor = self.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def executemany(self, sql, seq_of_params):
+        cursor = self.cursor()
+        cursor.executemany(sql, seq_of_params)
+        return cursor
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        if self.raw is not None:
+            self.backend.pool.release(self.raw)
+            self.raw = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class SQLiteBackend:
+    name = 'sqlite'
+
+    def __init__(self, path, pool_size=10, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.pool = ConnectionPool(self._connect, pool_size)
+        self.init_lock = threading.Lock()
+
+    def _connect(self):
+        raw = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        raw.row_factory = sqlite3.Row
+        raw.execute('PRAGMA journal_mode=WAL')
+        raw.execute('PRAGMA synchronous=NORMAL')
+        raw.execute('PRAGMA foreign_keys=OFF')
+        return raw
+
+    def connect(self):
+        return PooledConnection(self, self.pool.acquire())
+
+    def wrap_cursor(self, raw):
+        return raw.cursor()
+
+def plain_params(params):
+    return tuple(p.item() if isinstance(p, np.generic) else p for p in params)
+
+class PostgresCursor:
+    def __init__(self, backend, raw_cursor):
+        self.backend = backend
+        self.raw = raw_cursor
+
+    def execute(self, sql, params=()):
+        self.raw.execute(self.backend.translate(sql), plain_params(params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        psycopg2.extras.execute_batch(self.raw, self.backend.translate(sql), [plain_params(p) for p in seq_of_params], page_size=500)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def __iter__(self):
+        return iter(self.raw)
+
+class PostgresBackend:
+    name = 'postgresql'
+
+    DDL_REPLACEMENTS = [
+        (re.compile(r'INTEGER PRIMARY KEY AUTOINCREMENT', re.I), 'SERIAL PRIMARY KEY'),
+        (re.compile(r'\bBLOB\b', re.I), 'BYTEA'),
+        (re.compile(r'ADD COLUMN (?!IF NOT EXISTS)', re.I), 'ADD COLUMN IF NOT EXISTS '),
+        (re.compile(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)', re.I), ''),
+    ]
+
+    def __init__(self, dsn, pool_size=10):
+        if psycopg2 is None:
+            raise RuntimeError('psycopg2 is required for a postgresql:// DATABASE_URL')
+        self.dsn = dsn
+        self.pool = ConnectionPool(self._connect, pool_size)
+        self.translations = {}
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=psycopg2.extras.DictCursor)
+
+    def connect(self):
+        return PooledConnection(self, self.pool.acquire())
+
+    def wrap_cursor(self, raw):
+        return PostgresCursor(self, raw.cursor())
+
+    def translate(self, sql):
+        translated = self.translations.get(sql)
+        if translated is None:
+            parts = []
+            for code, text in split_literals(sql):
+                if code:
+                    text = text.replace('%', '%%').replace('?', '%s')
+                    for pattern, replacement in self.DDL_REPLACEMENTS:
+                        text = pattern.sub(replacement, text)
+                else:
+                    text = text.replace('%', '%%')
+                parts.append((code, text))
+            if parts and parts[0][0] and re.match(r'\s*INSERT OR IGNORE INTO', parts[0][1], re.I):
+                parts[0] = (True, re.sub(r'INSERT OR IGNORE INTO', 'INSERT INTO', parts[0][1], count=1, flags=re.I))
+                parts = self._add_on_conflict(parts)
+            translated = ''.join(text for _, text in parts)
+            self.translations[sql] = translated
+        return translated
+
+    def _add_on_conflict(self, parts):
+        for i, (code, text) in enumerate(parts):
+            match = re.search(r'\bRETURNING\b', text, re.I) if code else None
+            if match:
+                parts[i] = (True, text[:match.start()] + 'ON CONFLICT DO NOTHING ' + text[match.start():])
+                return parts
+        code, text = parts[-1]
+        body = text.rstrip() if code else text
+        tail = ''
+        if body.endswith(';'):
+            body, tail = body[:-1], ';'
+        parts[-1] = (code, body + ('\n' if not code else ' ') + 'ON CONFLICT DO NOTHING' + tail)
+        return parts
+
+def split_literals(sql):
+    parts = []
+    start = 0
+    i = 0
+    while i < len(sql):
+        ch = sql[i]
+        if ch in ("'", '"') or sql.startswith('--', i):
+            if i > start:
+                parts.append((True, sql[start:i]))
+            if ch in ("'", '"'):
+                end = i + 1
+                while True:
+                    end = sql.find(ch, end)
+                    if end == -1:
+                        end = len(sql)
+                        break
+                    if sql.startswith(ch * 2, end):
+                        end += 2
+                        continue
+                    end += 1
+                    break
+            else:
+                end = sql.find('\n', i)
+                end = len(sql) if end == -1 else end
+            parts.append((False, sql[i:end]))
+            start = i = end
+        else:
+            i += 1
+    if start < len(sql):
+        parts.append((True, sql[start:]))
+    return parts
+
+def create_backend(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith(('postgresql://', 'postgres://')):
+        return PostgresBackend(url)
+    raise ValueError(f'Unsupported DATABASE_URL: {url}')
@@ -1,14 +1,22 @@
-import sqlite3
 import hashlib
 import json
+import logging
 
-DATABASE = 'smart_study.db'
+from database.backends import create_backend
+from utils.compression import compress_text, decompress_text
+from utils.config import DATABASE_URL
+from utils.metrics import registry as metrics, timed_functions
+
+logger = logging.getLogger(__name__)
+
+backend = create_backend(DATABASE_URL)
+DATABASE = getattr(backend, 'path', None)
 
 def get_db_connection():
-    return sqlite3.connect(DATABASE)
+    return backend.connect()
 
 def init_db():
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -31,10 +39,11 @@ def init_db():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         filename TEXT NOT NULL,
         sha TEXT NOT NULL,
-        content TEXT,
+        content BLOB,
         subject_id INTEGER,
         upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         indexed INTEGER DEFAULT 0,
+        content_codec TEXT,
         FOREIGN KEY (subject_id) REFERENCES subjects (id)
     )''')
     cursor.execute('''CREATE TABLE IF NOT EXISTS qa_logs (
@@ -60,6 +69,14 @@ def init_db():
         cursor.execute('ALTER TABLE qa_logs ADD COLUMN confidence_score REAL')
     except:
         pass
+    try:
+        cursor.execute('ALTER TABLE qa_logs ADD COLUMN stage_timings TEXT')
+    except:
+        pass
+    try:
+        cursor.execute('ALTER TABLE materials ADD COLUMN content_codec TEXT')
+    except:
+        pass
     cursor.execute('''CREATE TABLE IF NOT EXISTS qa_corrections (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         qa_log_id INTEGER,
@@ -76,9 +93,32 @@ def init_db():
         teacher_id INTEGER,
         questions TEXT NOT NULL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        question_count INTEGER NOT NULL DEFAULT 0,
         FOREIGN KEY (subject_id) REFERENCES subjects (id),
         FOREIGN KEY (teacher_id) REFERENCES users (id)
     )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS quiz_questions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        quiz_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        question TEXT NOT NULL,
+        option_a TEXT NOT NULL,
+        option_b TEXT NOT NULL,
+        option_c TEXT NOT NULL,
+        option_d TEXT NOT NULL,
+        correct TEXT NOT NULL,
+        type TEXT NOT NULL DEFAULT 'multiple_choice',
+        times_answered INTEGER NOT NULL DEFAULT 0,
+        times_correct INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (quiz_id) REFERENCES quizzes (id)
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_quiz_questions_quiz ON quiz_questions (quiz_id, position)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_quizzes_subject ON quizzes (subject_id)')
+    try:
+        cursor.execute('ALTER TABLE quizzes ADD COLUMN question_count INTEGER NOT NULL DEFAULT 0')
+    except:
+        pass
+    migrate_quiz_questions(cursor)
     cursor.execute('''CREATE TABLE IF NOT EXISTS quiz_assignments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         quiz_id INTEGER,
@@ -87,6 +127,8 @@ def init_db():
         FOREIGN KEY (quiz_id) REFERENCES quizzes (id),
         FOREIGN KEY (student_id) REFERENCES users (id)
     )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_quiz_assignments_student ON quiz_assignments (student_id, quiz_id)')
+    migrate_unique_memberships(cursor)
     cursor.execute('''CREATE TABLE IF NOT EXISTS quiz_results (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -97,15 +139,126 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users (id),
         FOREIGN KEY (quiz_id) REFERENCES quizzes (id)
     )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS quiz_answers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        result_id INTEGER NOT NULL,
+        quiz_id INTEGER NOT NULL,
+        question_id INTEGER,
+        user_id INTEGER NOT NULL,
+        selected TEXT,
+        is_correct INTEGER NOT NULL,
+        FOREIGN KEY (result_id) REFERENCES quiz_results (id),
+        FOREIGN KEY (question_id) REFERENCES quiz_questions (id),
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_quiz_answers_question ON quiz_answers (quiz_id, question_id)')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS student_quiz_status (
+        user_id INTEGER NOT NULL,
+        quiz_id INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        latest_result_id INTEGER,
+        latest_score REAL,
+        best_score REAL,
+        completed_at TIMESTAMP,
+        PRIMARY KEY (user_id, quiz_id),
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (quiz_id) REFERENCES quizzes (id)
+    )''')
+    migrate_student_quiz_status(cursor)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS quiz_option_counts (
+        question_id INTEGER NOT NULL,
+        option TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (question_id, option),
+        FOREIGN KEY (question_id) REFERENCES quiz_questions (id)
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS student_mastery (
+        user_id INTEGER NOT NULL,
+        subject_id INTEGER NOT NULL,
+        answered INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, subject_id),
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (subject_id) REFERENCES subjects (id)
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        user_id INTEGER,
+        question TEXT NOT NULL,
+        answer TEXT NOT NULL,
+        source_chunks TEXT,
+        confidence REAL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history (session_id, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_created ON chat_history (created_at)')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS chat_sessions (
+        session_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        summary TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS question_bank (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chunk_hash TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        prompt_version INTEGER NOT NULL,
+        subject_id INTEGER,
+        material_id INTEGER,
+        chunk_id INTEGER,
+        question TEXT NOT NULL,
+        option_a TEXT,
+        option_b TEXT,
+        option_c TEXT,
+        option_d TEXT,
+        correct TEXT NOT NULL,
+        type TEXT NOT NULL DEFAULT 'multiple_choice',
+        times_served INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (subject_id) REFERENCES subjects (id),
+        FOREIGN KEY (material_id) REFERENCES materials (id)
+    )''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_question_bank_key ON question_bank (chunk_hash, difficulty, prompt_version, question)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_question_bank_subject ON question_bank (subject_id, difficulty)')
     cursor.execute('''CREATE TABLE IF NOT EXISTS teacher_chat (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         from_id INTEGER NOT NULL,
         to_id INTEGER NOT NULL,
         message TEXT NOT NULL,
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        client_msg_id TEXT,
+        conv_lo INTEGER,
+        conv_hi INTEGER,
         FOREIGN KEY (from_id) REFERENCES users (id),
         FOREIGN KEY (to_id) REFERENCES users (id)
     )''')
+    try:
+        cursor.execute('ALTER TABLE teacher_chat ADD COLUMN client_msg_id TEXT')
+    except:
+        pass
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_teacher_chat_client_msg ON teacher_chat (from_id, client_msg_id)')
+    try:
+        cursor.execute('ALTER TABLE teacher_chat ADD COLUMN conv_lo INTEGER')
+    except:
+        pass
+    try:
+        cursor.execute('ALTER TABLE teacher_chat ADD COLUMN conv_hi INTEGER')
+    except:
+        pass
+    cursor.execute('UPDATE teacher_chat SET conv_lo = CASE WHEN from_id < to_id THEN from_id ELSE to_id END, conv_hi = CASE WHEN from_id < to_id THEN to_id ELSE from_id END WHERE conv_lo IS NULL')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teacher_chat_conversation ON teacher_chat (conv_lo, conv_hi, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teacher_chat_recipient ON teacher_chat (to_id, from_id, id)')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS chat_reads (
+        user_id INTEGER NOT NULL,
+        other_id INTEGER NOT NULL,
+        last_read_id INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, other_id),
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (other_id) REFERENCES users (id)
+    )''')
     cursor.execute('''CREATE TABLE IF NOT EXISTS notes (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -120,8 +273,7 @@ def init_db():
     cursor.execute('SELECT COUNT(*) FROM subjects')
     if cursor.fetchone()[0] == 0:
         default_subjects = ['Math', 'Science', 'English', 'History']
-        for subject in default_subjects:
-            cursor.execute('INSERT INTO subjects (name) VALUES (?)', (subject,))
+        cursor.executemany('INSERT INTO subjects (name) VALUES (?)', [(subject,) for subject in default_subjects])
     cursor.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('admin',))
     if cursor.fetchone()[0] == 0:
         admin_password = hashlib.sha256('admin'.encode()).hexdigest()
@@ -129,6 +281,21 @@ def init_db():
     conn.commit()
     conn.close()
 
+def migrate_unique_memberships(cursor):
+    cursor.execute('DELETE FROM quiz_assignments WHERE id NOT IN (SELECT MIN(id) FROM quiz_assignments GROUP BY quiz_id, student_id)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_quiz_assignments_unique ON quiz_assignments (quiz_id, student_id)')
+    cursor.execute('DELETE FROM user_subjects WHERE id NOT IN (SELECT MIN(id) FROM user_subjects GROUP BY user_id, subject_id)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_user_subjects_unique ON user_subjects (user_id, subject_id)')
+
+def _select_in(cursor, query, values, chunk_size=500):
+    rows = []
+    values = list(values)
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        cursor.execute(query.format(placeholders=', '.join('?' * len(chunk))), chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
 def verify_user(username, password):
     try:
         conn = get_db_connection()
@@ -138,7 +305,7 @@ def verify_user(username, password):
         u = c.fetchone()
         conn.close()
         if u:
-            return {'id': u[0], 'username': u[1], 'role': u[2]}
+            return dict(u)
         return None
     except:
         return None
@@ -148,8 +315,8 @@ def add_user(username, password, role):
         conn = get_db_connection()
         c = conn.cursor()
         h = hashlib.sha256(password.encode()).hexdigest()
-        c.execute('INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)', (username, h, role))
-        id = c.lastrowid
+        c.execute('INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?) RETURNING id', (username, h, role))
+        id = c.fetchone()['id']
         conn.commit()
         conn.close()
         return id
@@ -163,10 +330,7 @@ def get_all_users():
         c.execute('SELECT id, username, role FROM users ORDER BY username')
         rows = c.fetchall()
         conn.close()
-        users = []
-        for r in rows:
-            users.append({'id': r[0], 'username': r[1], 'role': r[2]})
-        return users
+        return [dict(r) for r in rows]
     except:
         return []
 
@@ -185,39 +349,49 @@ def add_material(filename, content, subject_id, indexed=0):
         conn = get_db_connection()
         c = conn.cursor()
         h = hashlib.sha256(content.encode()).hexdigest()
-        c.execute('INSERT INTO materials (filename, sha, content, subject_id, indexed) VALUES (?, ?, ?, ?, ?)', (filename, h, content, subject_id, indexed))
-        id = c.lastrowid
+        data, codec = compress_text(content)
+        c.execute('INSERT INTO materials (filename, sha, content, subject_id, indexed, content_codec) VALUES (?, ?, ?, ?, ?, ?) RETURNING id', (filename, h, data, subject_id, indexed, codec))
+        id = c.fetchone()['id']
         conn.commit()
         conn.close()
         return id
     except:
         return None
 
+MATERIAL_FIELDS = 'id, filename, sha, content, subject_id, upload_time, indexed, content_codec'
+
+def _material_row(r):
+    try:
+        content = decompress_text(r['content'], r['content_codec'])
+    except Exception:
+        logger.exception('Could not read content of material %s (codec %s)', r['id'], r['content_codec'])
+        content = None
+    return {'id': r['id'], 'filename': r['filename'], 'sha': r['sha'], 'content': content, 'subject_id': r['subject_id'], 'upload_time': r['upload_time'], 'indexed': r['indexed']}
+
 def get_materials():
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute('SELECT * FROM materials ORDER BY upload_time DESC')
+        c.execute(f'SELECT {MATERIAL_FIELDS} FROM materials ORDER BY upload_time DESC')
         rows = c.fetchall()
         conn.close()
-        materials = []
-        for r in rows:
-            materials.append({'id': r[0], 'filename': r[1], 'sha': r[2], 'content': r[3], 'subject_id': r[4], 'upload_time': r[5], 'indexed': r[6]})
-        return materials
+        return [_material_row(r) for r in rows]
     except:
+        logger.exception('Could not load materials')
         return []
 
 def get_material_by_id(material_id):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute('SELECT * FROM materials WHERE id = ?', (material_id,))
+        c.execute(f'SELECT {MATERIAL_FIELDS} FROM materials WHERE id = ?', (material_id,))
         r = c.fetchone()
         conn.close()
         if r:
-            return {'id': r[0], 'filename': r[1], 'sha': r[2], 'content': r[3], 'subject_id': r[4], 'upload_time': r[5], 'indexed': r[6]}
+            return _material_row(r)
         return None
     except:
+        logger.exception('Could not load material %s', material_id)
         return None
 
 def delete_material(material_id):
@@ -242,19 +416,105 @@ def update_material_indexed(material_id, indexed=1):
     except:
         return False
 
-def log_qa(user_id, question, answer, response_time=None, source_chunks=None, confidence_score=None):
+def chunk_ref(source):
+    meta = source.get('metadata') or {}
+    material_id = source.get('material_id', meta.get('material_id'))
+    if material_id is None and str(meta.get('file_path', '')).startswith('db:'):
+        material_id = int(meta['file_path'][3:])
+    ref = {'material_id': material_id, 'chunk_id': source.get('chunk_id', meta.get('chunk_id')), 'score': source.get('score', 0)}
+    if material_id is None and source.get('chunk'):
+        ref['chunk'] = source['chunk']
+    return ref
+
+def log_qa_batch(entries):
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        source_chunks_json = json.dumps(source_chunks) if source_chunks else None
-        c.execute('INSERT INTO qa_logs (user_id, question, answer, response_time, source_chunks, confidence_score) VALUES (?, ?, ?, ?, ?, ?)', 
-                 (user_id, question, answer, response_time, source_chunks_json, confidence_score))
-        log_id = c.lastrowid
+        rows = []
+        for e in entries:
+            source_chunks = e.get('source_chunks')
+            source_chunks_json = json.dumps([chunk_ref(s) for s in source_chunks]) if source_chunks else None
+            stage_timings_json = json.dumps(e['stage_timings']) if e.get('stage_timings') else None
+            rows.append((e['user_id'], e['question'], e['answer'], e.get('response_time'), source_chunks_json, e.get('confidence_score'), stage_timings_json, e.get('timestamp')))
+        c.executemany('INSERT INTO qa_logs (user_id, question, answer, response_time, source_chunks, confidence_score, stage_timings, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))', rows)
         conn.commit()
         conn.close()
-        return log_id
+        return True
     except:
-        return None
+        return False
+
+def get_stage_timings(limit=2000):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT stage_timings FROM qa_logs WHERE stage_timings IS NOT NULL ORDER BY id DESC LIMIT ?', (limit,))
+        rows = c.fetchall()
+        conn.close()
+        return [json.loads(r['stage_timings']) for r in rows]
+    except:
+        return []
+
+def add_chat_turn(session_id, user_id, question, answer, sources, confidence, max_turns=10, summary=None):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        if summary is not None:
+            c.execute('INSERT INTO chat_sessions (session_id, user_id, summary, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP) ON CONFLICT (session_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at',
+                      (session_id, user_id, summary))
+        c.execute('INSERT INTO chat_history (session_id, user_id, question, answer, source_chunks, confidence) VALUES (?, ?, ?, ?, ?, ?)',
+                  (session_id, user_id, question, answer, json.dumps([chunk_ref(s) for s in sources]), confidence))
+        c.execute('DELETE FROM chat_history WHERE session_id = ? AND id NOT IN (SELECT id FROM chat_history WHERE session_id = ? ORDER BY id DESC LIMIT ?)', (session_id, session_id, max_turns))
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
+
+def get_chat_turns(session_id, limit=10):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT id, question, answer, source_chunks, confidence, created_at FROM chat_history WHERE session_id = ? ORDER BY id DESC LIMIT ?', (session_id, limit))
+        rows = c.fetchall()
+        conn.close()
+        return [dict(r, source_chunks=json.loads(r['source_chunks']) if r['source_chunks'] else []) for r in reversed(rows)]
+    except:
+        return []
+
+def get_chat_summary(session_id):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT summary FROM chat_sessions WHERE session_id = ?', (session_id,))
+        row = c.fetchone()
+        conn.close()
+        return row['summary'] if row and row['summary'] else ''
+    except:
+        return ''
+
+def delete_chat_session(session_id):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('DELETE FROM chat_history WHERE session_id = ?', (session_id,))
+        c.execute('DELETE FROM chat_sessions WHERE session_id = ?', (session_id,))
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
+
+def prune_chat_history(before):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('DELETE FROM chat_history WHERE created_at < ?', (before,))
+        c.execute('DELETE FROM chat_sessions WHERE updated_at < ?', (before,))
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
 
 def get_qa_logs(user_id=None):
     try:
@@ -268,17 +528,9 @@ def get_qa_logs(user_id=None):
         conn.close()
         logs = []
         for r in rows:
-            source_chunks = json.loads(r[6]) if r[6] else []
-            logs.append({
-                'id': r[0],
-                'user_id': r[1],
-                'question': r[2], 
-                'answer': r[3], 
-                'timestamp': r[4],
-                'response_time': r[5],
-                'source_chunks': source_chunks,
-                'confidence_score': r[7]
-            })
+            log = dict(r)
+            log['source_chunks'] = json.loads(r['source_chunks']) if r['source_chunks'] else []
+            logs.append(log)
         return logs
     except:
         return []
@@ -287,9 +539,9 @@ def add_qa_correction(qa_log_id, teacher_id, corrected_answer):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO qa_corrections (qa_log_id, teacher_id, corrected_answer) VALUES (?, ?, ?)', 
+        cursor.execute('INSERT INTO qa_corrections (qa_log_id, teacher_id, corrected_answer) VALUES (?, ?, ?) RETURNING id', 
                       (qa_log_id, teacher_id, corrected_answer))
-        correction_id = cursor.lastrowid
+        correction_id = cursor.fetchone()['id']
         conn.commit()
         conn.close()
         return correction_id
@@ -300,19 +552,24 @@ def get_qa_corrections(qa_log_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM qa_corrections WHERE qa_log_id = ? ORDER BY created_at DESC', (qa_log_id,))
+        cursor.execute('SELECT id, qa_log_id, teacher_id, corrected_answer, created_at FROM qa_corrections WHERE qa_log_id = ? ORDER BY created_at DESC', (qa_log_id,))
         rows = cursor.fetchall()
         conn.close()
-        corrections = []
-        for r in rows:
-            corrections.append({
-                'id': r[0],
-                'qa_log_id': r[1],
-                'teacher_id': r[2],
-                'corrected_answer': r[3],
-                'created_at': r[4]
-            })
-        return corrections
+        return [dict(r) for r in rows]
+    except:
+        return []
+
+def get_corrected_questions():
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''SELECT l.id, l.question, c.corrected_answer FROM qa_corrections c
+                          JOIN qa_logs l ON l.id = c.qa_log_id
+                          WHERE c.id = (SELECT MAX(id) FROM qa_corrections WHERE qa_log_id = c.qa_log_id)
+                          ORDER BY l.id''')
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
     except:
         return []
 
@@ -320,13 +577,10 @@ def get_subjects():
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM subjects ORDER BY name')
+        cursor.execute('SELECT id, name FROM subjects ORDER BY name')
         rows = cursor.fetchall()
         conn.close()
-        subjects = []
-        for r in rows:
-            subjects.append({'id': r[0], 'name': r[1]})
-        return subjects
+        return [dict(r) for r in rows]
     except:
         return []
 
@@ -337,10 +591,7 @@ def get_user_subjects(user_id):
         cursor.execute('SELECT s.id, s.name FROM subjects s JOIN user_subjects us ON s.id = us.subject_id WHERE us.user_id = ? ORDER BY s.name', (user_id,))
         rows = cursor.fetchall()
         conn.close()
-        subjects = []
-        for r in rows:
-            subjects.append({'id': r[0], 'name': r[1]})
-        return subjects
+        return [dict(r) for r in rows]
     except:
         return []
 
@@ -354,6 +605,56 @@ def assign_user_subject(user_id, subject_id):
     except:
         pass
 
+def assign_user_subjects(pairs):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO user_subjects (user_id, subject_id) VALUES (?, ?)', [(int(u), int(s)) for u, s in pairs])
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
+
+def get_all_user_subjects():
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT us.user_id, s.id, s.name FROM user_subjects us JOIN subjects s ON s.id = us.subject_id ORDER BY s.name')
+        rows = cursor.fetchall()
+        conn.close()
+        by_user = {}
+        for r in rows:
+            by_user.setdefault(r['user_id'], []).append({'id': r['id'], 'name': r['name']})
+        return by_user
+    except:
+        return {}
+
+def import_roster(rows):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        subject_names = {name for row in rows for name in row['subjects']}
+        existing_subjects = {r['name'] for r in _select_in(cursor, 'SELECT name FROM subjects WHERE name IN ({placeholders})', subject_names)}
+        cursor.executemany('INSERT OR IGNORE INTO subjects (name) VALUES (?)', [(name,) for name in subject_names - existing_subjects])
+        subject_ids = {r['name']: r['id'] for r in _select_in(cursor, 'SELECT id, name FROM subjects WHERE name IN ({placeholders})', subject_names)}
+        usernames = {row['username'] for row in rows}
+        existing_users = {r['username'] for r in _select_in(cursor, 'SELECT username FROM users WHERE username IN ({placeholders})', usernames)}
+        new_users = {}
+        for row in rows:
+            if row['username'] not in existing_users and row['username'] not in new_users:
+                new_users[row['username']] = (row['username'], hashlib.sha256(row['password'].encode()).hexdigest(), row['role'])
+        cursor.executemany('INSERT OR IGNORE INTO users (username, password_hash, role) VALUES (?, ?, ?)', list(new_users.values()))
+        user_ids = {r['username']: r['id'] for r in _select_in(cursor, 'SELECT id, username FROM users WHERE username IN ({placeholders})', usernames)}
+        memberships = {(user_ids[row['username']], subject_ids[name]) for row in rows for name in row['subjects'] if row['username'] in user_ids and name in subject_ids}
+        existing_memberships = {(r['user_id'], r['subject_id']) for r in _select_in(cursor, 'SELECT user_id, subject_id FROM user_subjects WHERE user_id IN ({placeholders})', set(user_ids.values()))}
+        cursor.executemany('INSERT OR IGNORE INTO user_subjects (user_id, subject_id) VALUES (?, ?)', list(memberships - existing_memberships))
+        conn.commit()
+        return {'users_created': len(new_users), 'users_existing': len(existing_users), 'subjects_created': len(subject_names - existing_subjects),
+                'memberships_added': len(memberships - existing_memberships)}
+    finally:
+        conn.close()
+
 def get_user_by_id(user_id):
     try:
         conn = get_db_connection()
@@ -362,7 +663,7 @@ def get_user_by_id(user_id):
         u = c.fetchone()
         conn.close()
         if u:
-            return {'id': u[0], 'username': u[1], 'role': u[2]}
+            return dict(u)
         return None
     except:
         return None
@@ -399,37 +700,90 @@ def remove_user_subjects(user_id):
     except:
         return False
 
+QUIZ_FIELDS = 'id, title, subject_id, teacher_id, question_count, created_at'
+QUESTION_FIELDS = 'id, position, question, option_a, option_b, option_c, option_d, correct, type, times_answered, times_correct'
+
+def _quiz_row(r):
+    return dict(r)
+
+def _question_row(r):
+    return {'id': r['id'], 'position': r['position'], 'question': r['question'], 'options': [r['option_a'], r['option_b'], r['option_c'], r['option_d']],
+            'correct': r['correct'], 'type': r['type'], 'times_answered': r['times_answered'], 'times_correct': r['times_correct']}
+
+def _question_values(quiz_id, position, q):
+    opts = list(q['options']) + [''] * (4 - len(q['options']))
+    return (quiz_id, position, q['question'], opts[0], opts[1], opts[2], opts[3], q['correct'], q.get('type', 'multiple_choice'))
+
+def _insert_questions(cursor, quiz_id, questions, start=0):
+    cursor.executemany('INSERT INTO quiz_questions (quiz_id, position, question, option_a, option_b, option_c, option_d, correct, type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       [_question_values(quiz_id, start + i, q) for i, q in enumerate(questions)])
+
+def migrate_quiz_questions(cursor):
+    cursor.execute("SELECT id, questions FROM quizzes WHERE questions != '[]' AND id NOT IN (SELECT DISTINCT quiz_id FROM quiz_questions)")
+    for r in cursor.fetchall():
+        quiz_id = r['id']
+        questions = json.loads(r['questions'])
+        _insert_questions(cursor, quiz_id, questions)
+        cursor.execute("UPDATE quizzes SET questions = '[]', question_count = ? WHERE id = ?", (len(questions), quiz_id))
+
+def migrate_student_quiz_status(cursor):
+    cursor.execute('SELECT 1 FROM student_quiz_status LIMIT 1')
+    if cursor.fetchone():
+        return
+    cursor.execute('''INSERT INTO student_quiz_status (user_id, quiz_id, attempts, latest_result_id, latest_score, best_score, completed_at)
+        SELECT qr.user_id, qr.quiz_id, agg.attempts, qr.id, qr.score, agg.best_score, qr.time
+        FROM quiz_results qr
+        JOIN (SELECT user_id, quiz_id, COUNT(*) AS attempts, MAX(score) AS best_score, MAX(id) AS latest_id FROM quiz_results GROUP BY user_id, quiz_id) agg ON qr.id = agg.latest_id''')
+
 def create_quiz(title, subject_id, teacher_id, questions):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        questions_json = json.dumps(questions)
-        cursor.execute('INSERT INTO quizzes (title, subject_id, teacher_id, questions) VALUES (?, ?, ?, ?)', (title, subject_id, teacher_id, questions_json))
-        quiz_id = cursor.lastrowid
+        cursor.execute("INSERT INTO quizzes (title, subject_id, teacher_id, questions, question_count) VALUES (?, ?, ?, '[]', ?) RETURNING id", (title, subject_id, teacher_id, len(questions)))
+        quiz_id = cursor.fetchone()['id']
+        _insert_questions(cursor, quiz_id, questions)
         conn.commit()
         conn.close()
         return quiz_id
     except:
         return None
 
-def update_quiz_questions(quiz_id, questions):
+def add_quiz_questions(quiz_id, questions):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        questions_json = json.dumps(questions)
-        cursor.execute('UPDATE quizzes SET questions = ? WHERE id = ?', (questions_json, quiz_id))
+        cursor.execute('SELECT COALESCE(MAX(position) + 1, 0) AS next_position FROM quiz_questions WHERE quiz_id = ?', (quiz_id,))
+        start = cursor.fetchone()['next_position']
+        _insert_questions(cursor, quiz_id, questions, start)
+        cursor.execute('UPDATE quizzes SET question_count = question_count + ? WHERE id = ?', (len(questions), quiz_id))
         conn.commit()
         conn.close()
         return True
     except:
         return False
 
+def add_quiz_question(quiz_id, question):
+    return add_quiz_questions(quiz_id, [question])
+
+def delete_quiz_question(quiz_id, question_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM quiz_questions WHERE id = ? AND quiz_id = ?', (question_id, quiz_id))
+        deleted = cursor.rowcount
+        if deleted:
+            cursor.execute('UPDATE quizzes SET question_count = question_count - 1 WHERE id = ?', (quiz_id,))
+        conn.commit()
+        conn.close()
+        return deleted > 0
+    except:
+        return False
+
 def assign_quiz_to_students(quiz_id, student_ids):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        for student_id in student_ids:
-            cursor.execute('INSERT OR IGNORE INTO quiz_assignments (quiz_id, student_id) VALUES (?, ?)', (quiz_id, student_id))
+        cursor.executemany('INSERT OR IGNORE INTO quiz_assignments (quiz_id, student_id) VALUES (?, ?)', [(quiz_id, int(student_id)) for student_id in student_ids])
         conn.commit()
         conn.close()
     except:
@@ -439,13 +793,10 @@ def get_teacher_quizzes(teacher_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM quizzes WHERE teacher_id = ? ORDER BY created_at DESC', (teacher_id,))
+        cursor.execute(f'SELECT {QUIZ_FIELDS} FROM quizzes WHERE teacher_id = ? ORDER BY created_at DESC', (teacher_id,))
         rows = cursor.fetchall()
         conn.close()
-        quizzes = []
-        for r in rows:
-            quizzes.append({'id': r[0], 'title': r[1], 'subject_id': r[2], 'teacher_id': r[3], 'questions': json.loads(r[4]), 'created_at': r[5]})
-        return quizzes
+        return [_quiz_row(r) for r in rows]
     except:
         return []
 
@@ -453,48 +804,223 @@ def get_student_quizzes(student_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT q.* FROM quizzes q JOIN quiz_assignments qa ON q.id = qa.quiz_id WHERE qa.student_id = ? ORDER BY q.created_at DESC', (student_id,))
+        cursor.execute('''SELECT q.id, q.title, q.subject_id, q.teacher_id, q.question_count, q.created_at,
+            sqs.attempts, sqs.latest_score AS score, sqs.best_score, sqs.completed_at AS completed_time
+            FROM quizzes q JOIN quiz_assignments qa ON q.id = qa.quiz_id
+            LEFT JOIN student_quiz_status sqs ON sqs.user_id = qa.student_id AND sqs.quiz_id = q.id
+            WHERE qa.student_id = ? ORDER BY q.created_at DESC''', (student_id,))
         rows = cursor.fetchall()
         conn.close()
-        quizzes = []
-        for r in rows:
-            quizzes.append({'id': r[0], 'title': r[1], 'subject_id': r[2], 'teacher_id': r[3], 'questions': json.loads(r[4]), 'created_at': r[5]})
-        return quizzes
+        return [_quiz_row(r) for r in rows]
     except:
         return []
 
-def get_quiz_by_id(quiz_id):
+def get_quiz_status(user_id, quiz_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM quizzes WHERE id = ?', (quiz_id,))
-        quiz_row = cursor.fetchone()
+        cursor.execute('SELECT attempts, latest_result_id, latest_score, best_score, completed_at FROM student_quiz_status WHERE user_id = ? AND quiz_id = ?', (user_id, quiz_id))
+        row = cursor.fetchone()
         conn.close()
-        if quiz_row:
-            return {'id': quiz_row[0], 'title': quiz_row[1], 'subject_id': quiz_row[2], 'teacher_id': quiz_row[3], 'questions': json.loads(quiz_row[4]), 'created_at': quiz_row[5]}
+        return dict(row) if row else None
+    except:
         return None
+
+def get_quiz_questions(quiz_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {QUESTION_FIELDS} FROM quiz_questions WHERE quiz_id = ? ORDER BY position', (quiz_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        return [_question_row(r) for r in rows]
+    except:
+        return []
+
+def get_subject_question_version(subject_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*), COALESCE(MAX(qq.id), 0) FROM quiz_questions qq JOIN quizzes q ON q.id = qq.quiz_id WHERE q.subject_id = ?', (subject_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0], row[1]
+    except:
+        return 0, 0
+
+def get_subject_questions(subject_id, after_id=0):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT qq.id, qq.quiz_id, qq.question FROM quiz_questions qq JOIN quizzes q ON q.id = qq.quiz_id WHERE q.subject_id = ? AND qq.id > ? ORDER BY qq.id', (subject_id, after_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    except:
+        return []
+
+def get_quiz_by_id(quiz_id, include_questions=True):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {QUIZ_FIELDS} FROM quizzes WHERE id = ?', (quiz_id,))
+        quiz_row = cursor.fetchone()
+        if not quiz_row:
+            conn.close()
+            return None
+        quiz = _quiz_row(quiz_row)
+        if include_questions:
+            cursor.execute(f'SELECT {QUESTION_FIELDS} FROM quiz_questions WHERE quiz_id = ? ORDER BY position', (quiz_id,))
+            quiz['questions'] = [_question_row(r) for r in cursor.fetchall()]
+        conn.close()
+        return quiz
     except:
         return None
 
-def log_quiz_result(user_id, score, answers, quiz_id):
+def record_quiz_result(cursor, user_id, quiz_id, score, answers, time=None):
+    cursor.execute("INSERT INTO quiz_results (user_id, quiz_id, score, answers, time) VALUES (?, ?, ?, '[]', COALESCE(?, CURRENT_TIMESTAMP)) RETURNING id", (user_id, quiz_id, score, time))
+    result_id = cursor.fetchone()['id']
+    record_quiz_answers(cursor, result_id, user_id, quiz_id, answers)
+    cursor.execute('''INSERT INTO student_quiz_status (user_id, quiz_id, attempts, latest_result_id, latest_score, best_score, completed_at)
+        VALUES (?, ?, 1, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ON CONFLICT (user_id, quiz_id) DO UPDATE SET attempts = student_quiz_status.attempts + 1,
+            latest_result_id = excluded.latest_result_id, latest_score = excluded.latest_score, completed_at = excluded.completed_at,
+            best_score = CASE WHEN excluded.best_score > student_quiz_status.best_score THEN excluded.best_score ELSE student_quiz_status.best_score END''',
+                   (user_id, quiz_id, result_id, score, score, time))
+    return result_id
+
+def record_quiz_answers(cursor, result_id, user_id, quiz_id, answers, subject_id=None):
+    answered = [a for a in answers if a.get('question_id')]
+    cursor.executemany('INSERT INTO quiz_answers (result_id, quiz_id, question_id, user_id, selected, is_correct) VALUES (?, ?, ?, ?, ?, ?)',
+                       [(result_id, quiz_id, a.get('question_id'), user_id, a['user_answer'], int(a['is_correct'])) for a in answers])
+    cursor.executemany('UPDATE quiz_questions SET times_answered = times_answered + 1, times_correct = times_correct + ? WHERE id = ?',
+                       [(int(a['is_correct']), a['question_id']) for a in answered])
+    cursor.executemany('INSERT INTO quiz_option_counts (question_id, option, count) VALUES (?, ?, 1) ON CONFLICT (question_id, option) DO UPDATE SET count = quiz_option_counts.count + 1',
+                       [(a['question_id'], a['user_answer']) for a in answered if a['user_answer']])
+    if subject_id is None:
+        cursor.execute('SELECT subject_id FROM quizzes WHERE id = ?', (quiz_id,))
+        row = cursor.fetchone()
+        subject_id = row['subject_id'] if row else None
+    if subject_id and answers:
+        correct = sum(1 for a in answers if a['is_correct'])
+        cursor.execute('INSERT INTO student_mastery (user_id, subject_id, answered, correct) VALUES (?, ?, ?, ?) ON CONFLICT (user_id, subject_id) DO UPDATE SET answered = student_mastery.answered + excluded.answered, correct = student_mastery.correct + excluded.correct',
+                       (user_id, subject_id, len(answers), correct))
+
+def log_quiz_results_batch(entries):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        answers_json = json.dumps(answers)
-        cursor.execute('INSERT INTO quiz_results (user_id, quiz_id, score, answers) VALUES (?, ?, ?, ?)', (user_id, quiz_id, score, answers_json))
-        result_id = cursor.lastrowid
+        for e in entries:
+            record_quiz_result(cursor, e['user_id'], e['quiz_id'], e['score'], e['answers'], e.get('time'))
         conn.commit()
         conn.close()
-        return result_id
+        return True
     except:
-        return None
+        return False
+
+def get_quiz_stats(quiz_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {QUESTION_FIELDS} FROM quiz_questions WHERE quiz_id = ? ORDER BY position', (quiz_id,))
+        questions = [_question_row(r) for r in cursor.fetchall()]
+        cursor.execute('SELECT oc.question_id, oc.option, oc.count FROM quiz_option_counts oc JOIN quiz_questions qq ON oc.question_id = qq.id WHERE qq.quiz_id = ?', (quiz_id,))
+        option_counts = {}
+        for r in cursor.fetchall():
+            option_counts.setdefault(r['question_id'], {})[r['option']] = r['count']
+        conn.close()
+        for q in questions:
+            q['correct_rate'] = q['times_correct'] / q['times_answered'] if q['times_answered'] else None
+            counts = option_counts.get(q['id'], {})
+            q['option_counts'] = {letter: counts.get(letter, 0) for letter in ['A', 'B', 'C', 'D']}
+        return questions
+    except:
+        return []
+
+def get_bank_questions(chunk_hashes, difficulty, prompt_version):
+    if not chunk_hashes:
+        return {}
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        chunk_hashes = list(chunk_hashes)
+        placeholders = ', '.join('?' * len(chunk_hashes))
+        cursor.execute(f'SELECT id, chunk_hash, question, option_a, option_b, option_c, option_d, correct, type FROM question_bank WHERE difficulty = ? AND prompt_version = ? AND chunk_hash IN ({placeholders}) ORDER BY times_served, id',
+                       [difficulty, prompt_version] + chunk_hashes)
+        rows = cursor.fetchall()
+        conn.close()
+        banked = {}
+        for r in rows:
+            banked.setdefault(r['chunk_hash'], []).append({'id': r['id'], 'question': r['question'], 'options': [r['option_a'], r['option_b'], r['option_c'], r['option_d']],
+                                                            'correct': r['correct'], 'type': r['type']})
+        return banked
+    except:
+        return {}
+
+def add_bank_questions(entries):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO question_bank (chunk_hash, difficulty, prompt_version, subject_id, material_id, chunk_id, question, option_a, option_b, option_c, option_d, correct, type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(e['chunk_hash'], e['difficulty'], e['prompt_version'], e.get('subject_id'), e.get('material_id'), e.get('chunk_id')) + _question_values(None, None, e)[2:] for e in entries])
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
+
+def mark_bank_questions_served(bank_ids):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('UPDATE question_bank SET times_served = times_served + 1 WHERE id = ?', [(bank_id,) for bank_id in bank_ids])
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
+
+def get_question_bank_stats(subject_ids=None):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        query = '''SELECT qb.subject_id, s.name AS subject_name, COUNT(*) AS questions, COUNT(DISTINCT qb.chunk_hash) AS chunks,
+            SUM(qb.times_served) AS served, SUM(CASE WHEN qb.times_served > 0 THEN 1 ELSE 0 END) AS reused,
+            SUM(CASE WHEN qb.difficulty = 'easy' THEN 1 ELSE 0 END) AS easy,
+            SUM(CASE WHEN qb.difficulty = 'medium' THEN 1 ELSE 0 END) AS medium,
+            SUM(CASE WHEN qb.difficulty = 'hard' THEN 1 ELSE 0 END) AS hard
+            FROM question_bank qb LEFT JOIN subjects s ON qb.subject_id = s.id'''
+        params = []
+        if subject_ids is not None:
+            if not subject_ids:
+                conn.close()
+                return []
+            query += f" WHERE qb.subject_id IN ({', '.join('?' * len(subject_ids))})"
+            params = list(subject_ids)
+        cursor.execute(query + ' GROUP BY qb.subject_id, s.name ORDER BY s.name', params)
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    except:
+        return []
+
+def get_subject_mastery(subject_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT sm.user_id, u.username, sm.answered, sm.correct FROM student_mastery sm JOIN users u ON sm.user_id = u.id WHERE sm.subject_id = ? ORDER BY u.username', (subject_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(r, mastery=r['correct'] / r['answered'] if r['answered'] else None) for r in rows]
+    except:
+        return []
 
 def add_subject(name):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO subjects (name) VALUES (?)', (name,))
-        subject_id = cursor.lastrowid
+        cursor.execute('INSERT INTO subjects (name) VALUES (?) RETURNING id', (name,))
+        subject_id = cursor.fetchone()['id']
         conn.commit()
         conn.close()
         return subject_id
@@ -523,12 +1049,96 @@ def update_subject(subject_id, name):
     except:
         return False
 
+def get_chat_contacts(user_id, role):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        contact_role = 'teacher' if role == 'student' else 'student'
+        cursor.execute('SELECT DISTINCT u.id, u.username FROM users u JOIN user_subjects us1 ON u.id = us1.user_id JOIN user_subjects us2 ON us1.subject_id = us2.subject_id WHERE u.role = ? AND us2.user_id = ? ORDER BY u.username', (contact_role, user_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    except:
+        return []
+
+def add_chat_message(from_id, to_id, message, client_msg_id=None):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO teacher_chat (from_id, to_id, message, client_msg_id, conv_lo, conv_hi) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (from_id, client_msg_id) DO NOTHING RETURNING id, from_id, to_id, message, timestamp, client_msg_id',
+                       (from_id, to_id, message, client_msg_id, min(from_id, to_id), max(from_id, to_id)))
+        r = cursor.fetchone()
+        if r is None:
+            cursor.execute('SELECT id, from_id, to_id, message, timestamp, client_msg_id FROM teacher_chat WHERE from_id = ? AND client_msg_id = ?', (from_id, client_msg_id))
+            r = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        return dict(r) if r else None
+    except:
+        return None
+
+CHAT_MESSAGE_FIELDS = 'tc.id, tc.from_id, tc.to_id, tc.message, tc.timestamp, tc.client_msg_id, u1.username AS from_name, u2.username AS to_name'
+
+def get_chat_latest_id(user_id, other_user_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(id) AS latest_id FROM teacher_chat WHERE conv_lo = ? AND conv_hi = ?', (min(user_id, other_user_id), max(user_id, other_user_id)))
+        r = cursor.fetchone()
+        conn.close()
+        return r['latest_id'] or 0
+    except:
+        return 0
+
+def get_conversation_messages(user_id, other_user_id, since_id=None, before_id=None, limit=100):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        conv = (min(user_id, other_user_id), max(user_id, other_user_id))
+        base = f'SELECT {CHAT_MESSAGE_FIELDS} FROM teacher_chat tc JOIN users u1 ON tc.from_id = u1.id JOIN users u2 ON tc.to_id = u2.id WHERE tc.conv_lo = ? AND tc.conv_hi = ?'
+        if since_id is not None:
+            cursor.execute(base + ' AND tc.id > ? ORDER BY tc.id ASC LIMIT ?', conv + (since_id, limit))
+            rows = cursor.fetchall()
+        elif before_id is not None:
+            cursor.execute(base + ' AND tc.id < ? ORDER BY tc.id DESC LIMIT ?', conv + (before_id, limit))
+            rows = cursor.fetchall()[::-1]
+        else:
+            cursor.execute(base + ' ORDER BY tc.id DESC LIMIT ?', conv + (limit,))
+            rows = cursor.fetchall()[::-1]
+        conn.close()
+        return [dict(r) for r in rows]
+    except:
+        return []
+
+def get_unread_counts(user_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT tc.from_id, COUNT(*) AS unread FROM teacher_chat tc LEFT JOIN chat_reads cr ON cr.user_id = tc.to_id AND cr.other_id = tc.from_id WHERE tc.to_id = ? AND tc.id > COALESCE(cr.last_read_id, 0) GROUP BY tc.from_id', (user_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        return {r['from_id']: r['unread'] for r in rows}
+    except:
+        return {}
+
+def set_last_read_batch(entries):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO chat_reads (user_id, other_id, last_read_id) VALUES (?, ?, ?) ON CONFLICT (user_id, other_id) DO UPDATE SET last_read_id = CASE WHEN excluded.last_read_id > chat_reads.last_read_id THEN excluded.last_read_id ELSE chat_reads.last_read_id END',
+                           [(e['user_id'], e['other_id'], e['last_read_id']) for e in entries])
+        conn.commit()
+        conn.close()
+        return True
+    except:
+        return False
+
 def create_note(user_id, title, content, subject_id=None):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO notes (user_id, title, content, subject_id) VALUES (?, ?, ?, ?)', (user_id, title, content, subject_id))
-        note_id = cursor.lastrowid
+        cursor.execute('INSERT INTO notes (user_id, title, content, subject_id) VALUES (?, ?, ?, ?) RETURNING id', (user_id, title, content, subject_id))
+        note_id = cursor.fetchone()['id']
         conn.commit()
         conn.close()
         return note_id
@@ -540,15 +1150,12 @@ def get_user_notes(user_id, subject_id=None):
         conn = get_db_connection()
         cursor = conn.cursor()
         if subject_id:
-            cursor.execute('SELECT n.*, s.name as subject_name FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id WHERE n.user_id = ? AND n.subject_id = ? ORDER BY n.updated_at DESC', (user_id, subject_id))
+            cursor.execute('SELECT n.id, n.user_id, n.subject_id, n.title, n.content, n.created_at, n.updated_at, s.name AS subject_name FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id WHERE n.user_id = ? AND n.subject_id = ? ORDER BY n.updated_at DESC', (user_id, subject_id))
         else:
-            cursor.execute('SELECT n.*, s.name as subject_name FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id WHERE n.user_id = ? ORDER BY n.updated_at DESC', (user_id,))
+            cursor.execute('SELECT n.id, n.user_id, n.subject_id, n.title, n.content, n.created_at, n.updated_at, s.name AS subject_name FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id WHERE n.user_id = ? ORDER BY n.updated_at DESC', (user_id,))
         rows = cursor.fetchall()
         conn.close()
-        notes = []
-        for r in rows:
-            notes.append({'id': r[0], 'user_id': r[1], 'subject_id': r[2], 'title': r[3], 'content': r[4], 'created_at': r[5], 'updated_at': r[6], 'subject_name': r[7]})
-        return notes
+        return [dict(r) for r in rows]
     except:
         return []
 
@@ -556,11 +1163,11 @@ def get_note_by_id(note_id, user_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT n.*, s.name as subject_name FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id WHERE n.id = ? AND n.user_id = ?', (note_id, user_id))
+        cursor.execute('SELECT n.id, n.user_id, n.subject_id, n.title, n.content, n.created_at, n.updated_at, s.name AS subject_name FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id WHERE n.id = ? AND n.user_id = ?', (note_id, user_id))
         r = cursor.fetchone()
         conn.close()
         if r:
-            return {'id': r[0], 'user_id': r[1], 'subject_id': r[2], 'title': r[3], 'content': r[4], 'created_at': r[5], 'updated_at': r[6], 'subject_name': r[7]}
+            return dict(r)
         return None
     except:
         return None
@@ -586,3 +1193,6 @@ def delete_note(note_id, user_id):
         return True
     except:
         return False
+
+if metrics.enabled:
+    timed_functions(globals(), metrics.histogram('db_call_duration_seconds', 'database/db.py call latency', ('function',)), skip=('get_db_connection', 'chunk_ref'))
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import json
+
+from database.db import DATABASE, get_db_connection, init_db, chunk_ref, record_quiz_answers
+from utils.compression import compress_text
+
+def _stored_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return len(value)
+
+def migrate_compressed_storage(vacuum=True):
+    init_db()
+    report = {'materials_converted': 0, 'materials_bytes_before': 0, 'materials_bytes_after': 0,
+              'qa_logs_converted': 0, 'qa_logs_bytes_before': 0, 'qa_logs_bytes_after': 0}
+    file_size_before = os.path.getsize(DATABASE) if DATABASE and os.path.exists(DATABASE) else 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, content FROM materials WHERE content_codec IS NULL AND content IS NOT NULL')
+    for material_id, content in cursor.fetchall():
+        data, codec = compress_text(content)
+        conn.execute('UPDATE materials SET content = ?, content_codec = ? WHERE id = ?', (data, codec, material_id))
+        report['materials_converted'] += 1
+        report['materials_bytes_before'] += _stored_size(content)
+        report['materials_bytes_after'] += len(data)
+    cursor.execute('SELECT id, source_chunks FROM qa_logs WHERE source_chunks IS NOT NULL')
+    for log_id, source_chunks in cursor.fetchall():
+        try:
+            chunks = json.loads(source_chunks)
+        except ValueError:
+            continue
+        if not any('metadata' in c for c in chunks):
+            continue
+        refs = json.dumps([chunk_ref(c) for c in chunks])
+        conn.execute('UPDATE qa_logs SET source_chunks = ? WHERE id = ?', (refs, log_id))
+        report['qa_logs_converted'] += 1
+        report['qa_logs_bytes_before'] += _stored_size(source_chunks)
+        report['qa_logs_bytes_after'] += _stored_size(refs)
+    conn.commit()
+    conn.close()
+    if vacuum and DATABASE:
+        conn = sqlite3.connect(DATABASE)
+        conn.execute('VACUUM')
+        conn.close()
+    report['file_bytes_before'] = file_size_before
+    report['file_bytes_after'] = os.path.getsize(DATABASE) if DATABASE and os.path.exists(DATABASE) else 0
+    return report
+
+def backfill_quiz_answers():
+    init_db()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, user_id, quiz_id, answers FROM quiz_results WHERE answers != '[]'")
+    results = cursor.fetchall()
+    question_ids = {}
+    for result_id, user_id, quiz_id, answers_json in results:
+        if quiz_id not in question_ids:
+            cursor.execute('SELECT id, question FROM quiz_questions WHERE quiz_id = ?', (quiz_id,))
+            question_ids[quiz_id] = {question: qid for qid, question in cursor.fetchall()}
+        answers = json.loads(answers_json)
+        for a in answers:
+            a.setdefault('question_id', question_ids[quiz_id].get(a.get('question')))
+        record_quiz_answers(cursor, result_id, user_id, quiz_id, answers)
+        cursor.execute("UPDATE quiz_results SET answers = '[]' WHERE id = ?", (result_id,))
+    conn.commit()
+    conn.close()
+    return len(results)
+
+def format_report(report):
+    lines = []
+    for label, key in (('materials.content', 'materials'), ('qa_logs.source_chunks', 'qa_logs')):
+        before = report[f'{key}_bytes_before']
+        after = report[f'{key}_bytes_after']
+        saved = (1 - after / before) * 100 if before else 0
+        lines.append(f'{label}: {report[f"{key}_converted"]} rows, {before} -> {after} bytes ({saved:.1f}% smaller)')
+    before = report['file_bytes_before']
+    after = report['file_bytes_after']
+    saved = (1 - after / before) * 100 if before else 0
+    lines.append(f'{DATABASE}: {before} -> {after} bytes ({saved:.1f}% smaller)')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    print(f'quiz_results: {backfill_quiz_answers()} attempts moved to quiz_answers')
+    print(format_report(migrate_compressed_storage()))
@@ -0,0 +1,28 @@
+import threading
+
+class EmitBatcher:
+    def __init__(self, socketio, event='new_messages', interval=0.02):
+        self.socketio = socketio
+        self.event = event
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def add(self, room, payload):
+        with self.lock:
+            self.pending.setdefault(room, []).append(payload)
+            if not self.started:
+                self.started = True
+                self.socketio.start_background_task(self._run)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for room, payloads in pending.items():
+            self.socketio.emit(self.event, payloads, room=room)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            self.flush()
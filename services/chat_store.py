@@ -0,0 +1,88 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+
+from database.db import add_chat_turn, chunk_ref, delete_chat_session, get_chat_summary, get_chat_turns, prune_chat_history
+from utils.config import CHAT_HISTORY_STORE, CHAT_HISTORY_TURNS, CHAT_HISTORY_MAX_SESSIONS, CHAT_CONTEXT_TURNS, PERMANENT_SESSION_LIFETIME
+
+store_instance = None
+
+def chat_session_id(session):
+    if 'chat_sid' not in session:
+        session['chat_sid'] = uuid.uuid4().hex
+    return session['chat_sid']
+
+class MemoryChatStore:
+    def __init__(self, max_turns=CHAT_HISTORY_TURNS, max_sessions=CHAT_HISTORY_MAX_SESSIONS, ttl=PERMANENT_SESSION_LIFETIME):
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def append(self, session_id, user_id, question, answer, sources, confidence, summary=None):
+        turn = {'question': question, 'answer': answer, 'source_chunks': [chunk_ref(s) for s in sources], 'confidence': confidence}
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is None:
+                entry = {'turns': deque(maxlen=self.max_turns)}
+            entry['turns'].append(turn)
+            if summary is not None:
+                entry['summary'] = summary
+            entry['touched'] = time.time()
+            self.sessions[session_id] = entry
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def history(self, session_id):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return []
+            if time.time() - entry['touched'] > self.ttl:
+                del self.sessions[session_id]
+                return []
+            self.sessions.move_to_end(session_id)
+            return list(entry['turns'])
+
+    def conversation(self, session_id, turns=CHAT_CONTEXT_TURNS):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            summary = entry.get('summary', '') if entry else ''
+        return {'summary': summary, 'turns': self.history(session_id)[-turns:]}
+
+    def clear(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+class DatabaseChatStore:
+    def __init__(self, max_turns=CHAT_HISTORY_TURNS, ttl=PERMANENT_SESSION_LIFETIME, prune_interval=3600):
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.last_prune = 0
+
+    def append(self, session_id, user_id, question, answer, sources, confidence, summary=None):
+        add_chat_turn(session_id, user_id, question, answer, sources, confidence, max_turns=self.max_turns, summary=summary)
+        now = time.time()
+        if now - self.last_prune > self.prune_interval:
+            self.last_prune = now
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+            prune_chat_history(cutoff.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def history(self, session_id):
+        return get_chat_turns(session_id, limit=self.max_turns)
+
+    def conversation(self, session_id, turns=CHAT_CONTEXT_TURNS):
+        return {'summary': get_chat_summary(session_id), 'turns': get_chat_turns(session_id, limit=turns)}
+
+    def clear(self, session_id):
+        delete_chat_session(session_id)
+
+def get_chat_store():
+    global store_instance
+    if store_instance is None:
+        store_instance = DatabaseChatStore() if CHAT_HISTORY_STORE == 'database' else MemoryChatStore()
+    return store_instance
@@ -0,0 +1,114 @@
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from database.db import get_subject_question_version, get_subject_questions
+
+MERSENNE_PRIME = (1 << 31) - 1
+STOPWORDS = {'a', 'an', 'the', 'of', 'to', 'in', 'on', 'for', 'and', 'or', 'is', 'are', 'was', 'were', 'be', 'by',
+             'with', 'which', 'what', 'who', 'whom', 'how', 'why', 'when', 'where', 'does', 'do', 'did', 'following',
+             'that', 'this', 'these', 'those', 'it', 'its', 'as', 'at', 'from', 'can', 'most', 'best', 'describes'}
+
+subject_indexes = {}
+subject_indexes_lock = threading.Lock()
+
+def question_tokens(text):
+    tokens = set()
+    for word in re.findall(r'[a-z0-9]+', (text or '').lower()):
+        if word in STOPWORDS:
+            continue
+        for suffix in ('ing', 'ed', 'es', 's'):
+            if len(word) > len(suffix) + 3 and word.endswith(suffix):
+                word = word[:-len(suffix)]
+                break
+        tokens.add(word)
+    return tokens
+
+class MinHashIndex:
+    def __init__(self, num_perm=64, bands=16, threshold=0.7, seed=1):
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, num_perm).astype(np.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def signature(self, tokens):
+        hashes = np.array([zlib.crc32(t.encode('utf-8')) % MERSENNE_PRIME for t in tokens], dtype=np.uint64)
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def _band_keys(self, sig):
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, key, text):
+        tokens = question_tokens(text)
+        if not tokens:
+            return
+        band_keys = self._band_keys(self.signature(tokens))
+        with self.lock:
+            self.tokens[key] = tokens
+            for bucket, band_key in zip(self.buckets, band_keys):
+                bucket.setdefault(band_key, set()).add(key)
+
+    def find_similar(self, text, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        tokens = question_tokens(text)
+        if not tokens:
+            return None
+        band_keys = self._band_keys(self.signature(tokens))
+        with self.lock:
+            candidates = set()
+            for bucket, band_key in zip(self.buckets, band_keys):
+                candidates.update(bucket.get(band_key, ()))
+            for key in candidates:
+                other = self.tokens[key]
+                if len(tokens & other) / len(tokens | other) >= threshold:
+                    return key
+        return None
+
+    def add_if_new(self, key, text, threshold=None):
+        if self.find_similar(text, threshold) is not None:
+            return False
+        self.add(key, text)
+        return True
+
+class SubjectQuestionIndex:
+    def __init__(self, subject_id):
+        self.subject_id = subject_id
+        self.index = MinHashIndex()
+        self.count = 0
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        count, max_id = get_subject_question_version(self.subject_id)
+        with self.lock:
+            if count == self.count and max_id == self.last_id:
+                return self.index
+            rows = get_subject_questions(self.subject_id, after_id=self.last_id)
+            if self.count + len(rows) != count:
+                self.index = MinHashIndex()
+                rows = get_subject_questions(self.subject_id)
+            for row in rows:
+                self.index.add(row['id'], row['question'])
+            self.count = count
+            self.last_id = max_id
+            return self.index
+
+def get_subject_index(subject_id):
+    if not subject_id:
+        return None
+    subject_id = int(subject_id)
+    with subject_indexes_lock:
+        entry = subject_indexes.get(subject_id)
+        if entry is None:
+            entry = subject_indexes[subject_id] = SubjectQuestionIndex(subject_id)
+    return entry.refresh()
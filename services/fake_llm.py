@@ -0,0 +1,106 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+class FakeResponse:
+    def __init__(self, text=None, embeddings=None, results=None):
+        self.text = text
+        self.embeddings = embeddings
+        self.results = results
+
+class FakeChatClient:
+    def __init__(self, latency=0.0, failure_rate=0.0, malformed_rate=0.0, dim=64, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.dim = dim
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _roll(self):
+        with self.lock:
+            self.calls += 1
+            return self.calls, self.random.random()
+
+    def _enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def embed(self, texts, model=None, input_type=None, **kwargs):
+        return FakeResponse(embeddings=[self.embed_text(t) for t in texts])
+
+    def embed_text(self, text):
+        vec = np.zeros(self.dim)
+        for word in re.findall(r'\w+', text.lower()):
+            h = int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16)
+            vec[h % self.dim] += 1.0 if (h >> 8) & 1 else -1.0
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).tolist()
+
+    def rerank(self, query, documents, model=None, top_n=None, **kwargs):
+        self._roll()
+        terms = set(re.findall(r'\w+', query.lower()))
+        scored = [(i, len(terms & set(re.findall(r'\w+', d.lower()))) / (len(terms) or 1)) for i, d in enumerate(documents)]
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return FakeResponse(results=[SimpleNamespace(index=i, relevance_score=s) for i, s in scored[:top_n]])
+
+    def chat(self, message, model=None, preamble=None, chat_history=None, documents=None, **kwargs):
+        call_no, roll = self._roll()
+        self._enter()
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if roll < self.failure_rate:
+                raise RuntimeError('fake chat failure')
+            batch = re.match(r'Create (\d+) multiple choice questions', message)
+            if batch:
+                return FakeResponse(text=self._batch(message, int(batch.group(1)), call_no))
+            if 'multiple choice question' in message:
+                if roll < self.failure_rate + self.malformed_rate:
+                    return FakeResponse(text='Sorry, I cannot produce a question for this text.')
+                return FakeResponse(text=self._question(message, call_no))
+            context = ' '.join(d.get('text', '') for d in documents or [])
+            return FakeResponse(text=' '.join(context.split()[:60]) or 'No context provided.')
+        finally:
+            self._leave()
+
+    def _batch(self, prompt, count, call_no):
+        items = []
+        for i in range(count):
+            with self.lock:
+                roll = self.random.random()
+            if roll < self.malformed_rate:
+                continue
+            lines = self._question(prompt, call_no * 100 + i).split('\n')
+            items.append({
+                'excerpt': i + 1,
+                'question': lines[0][len('Question: '):],
+                'options': [line[3:] for line in lines[1:5]],
+                'answer': lines[5][len('Answer: '):]
+            })
+        return '```json\n' + json.dumps({'questions': items}) + '\n```'
+
+    def _question(self, prompt, call_no):
+        words = sorted({w.lower() for w in re.findall(r'[A-Za-z]{5,}', prompt.split('Difficulty:')[0])} - {'create', 'multiple', 'choice', 'question', 'questions', 'excerpt'})
+        if words:
+            topic = f'{words[call_no % len(words)]} and {words[(call_no + call_no // len(words) + 1) % len(words)]}'
+        else:
+            topic = 'topic'
+        correct = 'ABCD'[call_no % 4]
+        return (f"Question: Which statement about {topic} is supported by item {call_no}?\n"
+                f"A) {topic} option one\nB) {topic} option two\nC) {topic} option three\nD) {topic} option four\n"
+                f"Answer: {correct}")
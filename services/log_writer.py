@@ -0,0 +1,136 @@
+import atexit
+import json
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+
+from database.db import log_qa_batch, log_quiz_results_batch
+from utils.config import WRITE_BEHIND_QUEUE_SIZE, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_SPOOL_FILE
+
+writer_instance = None
+
+def utc_timestamp():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class WriteBehindLogger:
+    def __init__(self, handlers, max_queue=WRITE_BEHIND_QUEUE_SIZE, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval=WRITE_BEHIND_FLUSH_INTERVAL, spool_file=WRITE_BEHIND_SPOOL_FILE):
+        self.handlers = handlers
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_file = spool_file
+        self.spool_lock = threading.Lock()
+        self.enqueue_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.replay_spool()
+        self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def enqueue(self, kind, row, wait=False, timeout=5.0):
+        item = {'kind': kind, 'row': row, 'done': threading.Event() if wait else None}
+        queued = False
+        with self.enqueue_lock:
+            if not self.stopped.is_set() and self.thread.is_alive():
+                try:
+                    self.queue.put_nowait(item)
+                    queued = True
+                except queue.Full:
+                    pass
+        if not queued:
+            self._write([item])
+            return
+        if wait:
+            item['done'].wait(timeout)
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        with self.enqueue_lock:
+            if self.stopped.is_set():
+                return
+            self.stopped.set()
+        self.thread.join(timeout=10)
+        while True:
+            batch = self._drain([])
+            if not batch:
+                break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _drain(self, batch):
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = self._drain([first])
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        grouped = {}
+        for item in batch:
+            grouped.setdefault(item['kind'], []).append(item)
+        for kind, items in grouped.items():
+            rows = [item['row'] for item in items]
+            handler = self.handlers.get(kind)
+            if handler is None or not handler(rows):
+                self._spool(kind, rows)
+            for item in items:
+                if item['done'] is not None:
+                    item['done'].set()
+
+    def _spool(self, kind, rows):
+        with self.spool_lock:
+            with open(self.spool_file, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps({'kind': kind, 'row': row}) + '\n')
+
+    def replay_spool(self):
+        replay_file = self.spool_file + '.replay'
+        if os.path.exists(replay_file):
+            self._replay(replay_file)
+        if not os.path.exists(self.spool_file):
+            return
+        with self.spool_lock:
+            os.replace(self.spool_file, replay_file)
+        self._replay(replay_file)
+
+    def _replay(self, replay_file):
+        grouped = {}
+        with open(replay_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                grouped.setdefault(entry['kind'], []).append(entry['row'])
+        for kind, rows in grouped.items():
+            handler = self.handlers.get(kind)
+            if handler is None or not handler(rows):
+                self._spool(kind, rows)
+        os.remove(replay_file)
+
+def get_log_writer():
+    global writer_instance
+    if writer_instance is None:
+        writer_instance = WriteBehindLogger({'qa_log': log_qa_batch, 'quiz_result': log_quiz_results_batch})
+    return writer_instance
@@ -0,0 +1,51 @@
+import threading
+
+from database.db import get_unread_counts, set_last_read_batch
+
+def user_room(user_id):
+    return f'user_{int(user_id)}'
+
+class PresenceService:
+    def __init__(self, socketio):
+        self.socketio = socketio
+        self.lock = threading.Lock()
+        self.sids = {}
+
+    def connect(self, sid, user_id, contact_ids):
+        with self.lock:
+            first = not self.sids.get(user_id)
+            self.sids.setdefault(user_id, set()).add(sid)
+            online = [c for c in contact_ids if self.sids.get(c)]
+        if first:
+            self._notify_contacts(user_id, contact_ids, True)
+        return {'unread': get_unread_counts(user_id), 'online': online}
+
+    def disconnect(self, sid, user_id, contact_ids):
+        with self.lock:
+            user_sids = self.sids.get(user_id, set())
+            user_sids.discard(sid)
+            last = not user_sids
+            if last:
+                self.sids.pop(user_id, None)
+        if last:
+            self._notify_contacts(user_id, contact_ids, False)
+
+    def mark_read(self, user_id, other_id, last_message_id):
+        if not last_message_id:
+            return
+        set_last_read_batch([{'user_id': user_id, 'other_id': other_id, 'last_read_id': last_message_id}])
+        self._push_unread(user_id, other_id)
+
+    def message_sent(self, msg):
+        self._push_unread(msg['to_id'], msg['from_id'])
+
+    def typing(self, user_id, other_id, is_typing):
+        self.socketio.emit('typing', {'from_id': user_id, 'typing': bool(is_typing)}, room=user_room(other_id))
+
+    def _push_unread(self, user_id, other_id):
+        counts = get_unread_counts(user_id)
+        self.socketio.emit('unread_update', {'from_id': other_id, 'count': counts.get(other_id, 0), 'total': sum(counts.values())}, room=user_room(user_id))
+
+    def _notify_contacts(self, user_id, contact_ids, online):
+        for contact_id in contact_ids:
+            self.socketio.emit('presence', {'user_id': user_id, 'online': online}, room=user_room(contact_id))
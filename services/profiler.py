@@ -0,0 +1,170 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from utils.config import PROFILER_SAMPLE_RATE, PROFILER_MODE, PROFILER_INTERVAL, PROFILER_MAX_PROFILES
+
+profiler_instance = None
+
+class StackSampler:
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.targets = {}
+        self.labels = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def add(self, thread_id):
+        stacks = Counter()
+        with self.lock:
+            if thread_id in self.targets:
+                return None
+            self.targets[thread_id] = stacks
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self.thread.start()
+        self.wake.set()
+        return stacks
+
+    def remove(self, thread_id):
+        with self.lock:
+            return self.targets.pop(thread_id, None)
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            path = code.co_filename.replace(os.sep, '/').split('/')
+            label = self.labels[code] = f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+        return label
+
+    def collapse(self, frame):
+        names = []
+        while frame is not None:
+            names.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                targets = list(self.targets.items())
+                if not targets:
+                    self.wake.clear()
+            if not targets:
+                self.wake.wait()
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in targets:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[self.collapse(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+class RequestProfiler:
+    def __init__(self, sample_rate=PROFILER_SAMPLE_RATE, mode=PROFILER_MODE, interval=PROFILER_INTERVAL, max_profiles=PROFILER_MAX_PROFILES):
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.route_filter = ''
+        self.sampler = StackSampler(interval)
+        self.profiles = deque(maxlen=max_profiles)
+        self.routes = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.cprofile_lock = threading.Lock()
+        self.random = random.Random()
+
+    def configure(self, sample_rate=None, mode=None, route_filter=None):
+        if sample_rate is not None:
+            self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        if mode in ('sample', 'cprofile'):
+            self.mode = mode
+        if route_filter is not None:
+            self.route_filter = route_filter.strip()
+
+    def start(self, route, method, path, force=None):
+        mode = force
+        if mode is None:
+            if self.sample_rate <= 0 or (self.route_filter and route != self.route_filter) or self.random.random() >= self.sample_rate:
+                return None
+            mode = self.mode
+        token = {'route': route, 'method': method, 'path': path, 'mode': mode, 'started': time.time(), 'start': time.perf_counter()}
+        if mode == 'cprofile' and self.cprofile_lock.acquire(blocking=False):
+            token['profile'] = cProfile.Profile()
+            try:
+                token['profile'].enable()
+            except ValueError:
+                self.cprofile_lock.release()
+                del token['profile']
+        if 'profile' not in token:
+            token['mode'] = 'sample'
+            token['thread'] = threading.get_ident()
+            token['stacks'] = self.sampler.add(token['thread'])
+            if token['stacks'] is None:
+                return None
+        return token
+
+    def finish(self, token, status):
+        duration_ms = (time.perf_counter() - token['start']) * 1000
+        text = ''
+        if 'profile' in token:
+            token['profile'].disable()
+            self.cprofile_lock.release()
+            out = io.StringIO()
+            pstats.Stats(token['profile'], stream=out).sort_stats('cumulative').print_stats(60)
+            text = out.getvalue()
+            stacks = Counter()
+        else:
+            self.sampler.remove(token['thread'])
+            stacks = token['stacks']
+        with self.lock:
+            entry = {'id': self.next_id, 'route': token['route'], 'method': token['method'], 'path': token['path'],
+                     'mode': token['mode'], 'status': status, 'started': token['started'], 'duration_ms': round(duration_ms, 1),
+                     'samples': sum(stacks.values()), 'stacks': stacks, 'text': text}
+            self.next_id += 1
+            self.profiles.append(entry)
+            route = self.routes.setdefault(token['route'], {'requests': 0, 'samples': 0, 'duration_ms': 0.0, 'stacks': Counter()})
+            route['requests'] += 1
+            route['duration_ms'] += duration_ms
+            route['samples'] += entry['samples']
+            route['stacks'].update(stacks)
+        return entry
+
+    def get_profile(self, profile_id):
+        with self.lock:
+            return next((p for p in self.profiles if p['id'] == profile_id), None)
+
+    def route_stacks(self, route):
+        with self.lock:
+            entry = self.routes.get(route)
+            return Counter(entry['stacks']) if entry else None
+
+    def summary(self):
+        with self.lock:
+            routes = [{'route': name, 'requests': r['requests'], 'samples': r['samples'],
+                       'mean_ms': round(r['duration_ms'] / r['requests'], 1)} for name, r in self.routes.items()]
+            profiles = [{k: v for k, v in p.items() if k not in ('stacks', 'text')} for p in reversed(self.profiles)]
+        routes.sort(key=lambda r: r['samples'], reverse=True)
+        return {'sample_rate': self.sample_rate, 'mode': self.mode, 'route_filter': self.route_filter,
+                'routes': routes, 'profiles': profiles}
+
+    def reset(self):
+        with self.lock:
+            self.profiles.clear()
+            self.routes = {}
+
+def collapsed_text(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+def get_profiler():
+    global profiler_instance
+    if profiler_instance is None:
+        profiler_instance = RequestProfiler()
+    return profiler_instance
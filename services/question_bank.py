@@ -0,0 +1,13 @@
+from database.db import get_bank_questions, add_bank_questions, mark_bank_questions_served
+
+class QuestionBank:
+    def lookup(self, chunk_hashes, difficulty, prompt_version):
+        return get_bank_questions(chunk_hashes, difficulty, prompt_version)
+
+    def store(self, entries):
+        if entries:
+            add_bank_questions(entries)
+
+    def mark_served(self, bank_ids):
+        if bank_ids:
+            mark_bank_questions_served(bank_ids)
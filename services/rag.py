@@ -1,22 +1,72 @@
-import os,time
+import hashlib,json,math,os,re,threading,time
+from concurrent.futures import FIRST_COMPLETED,ThreadPoolExecutor,wait
 import numpy as np
 from rank_bm25 import BM25Okapi
 from sklearn.neighbors import NearestNeighbors
 import cohere
+from services.dedup import MinHashIndex
+from utils.metrics import registry as metrics,instrument_client
+from utils.config import QUIZ_GENERATION_WORKERS,QUIZ_GENERATION_DELAY,QUIZ_OVERGENERATION,QUIZ_BATCH_SIZE,CHAT_CONTEXT_TURNS,CHAT_SUMMARY_CHARS,CHAT_CONTEXT_TOKENS,CHUNK_OVERLAP,RERANK_CANDIDATES
+
+FOLLOWUP_PRONOUNS={'it','its','this','that','these','those','they','them','their','he','she','him','her','his'}
+FOLLOWUP_STARTERS={'and','but','also','what about','how about'}
+TOKENS_PER_WORD=4/3
+
+QUERY_COUNTER=metrics.counter('rag_queries_total','Chat queries answered by SmartStudyRAG',('mode',))
+STAGE_LATENCY=metrics.histogram('rag_stage_duration_seconds','SmartStudyRAG.query latency by stage',('stage',))
+REUSE_COUNTER=metrics.counter('rag_chunk_reuse_total','Follow-up questions answered from the previous turn\'s chunks',('outcome',))
+NO_ANSWER_COUNTER=metrics.counter('rag_no_answer_total','Answers that fell back to an apology',('reason',))
+QUIZ_SOURCE_COUNTER=metrics.counter('rag_quiz_questions_total','Quiz questions served by source',('source',))
+
+QUIZ_PROMPT_VERSION=1
+QUIZ_BATCH_SCHEMA={
+	'type':'object',
+	'required':['questions'],
+	'properties':{'questions':{'type':'array','items':{
+		'type':'object',
+		'required':['excerpt','question','options','answer'],
+		'properties':{
+			'excerpt':{'type':'integer'},
+			'question':{'type':'string'},
+			'options':{'type':'array','items':{'type':'string'}},
+			'answer':{'type':'string','enum':['A','B','C','D']}
+		}
+	}}}
+}
 
 class SmartStudyRAG:
-	def __init__(self,api_key):
-		self.client=cohere.Client(api_key)
+	def __init__(self,api_key,client=None):
+		self.client=instrument_client(client or cohere.Client(api_key))
 		self.chunks=[]
 		self.meta=[]
 		self.bm25=None
 		self.nn=None
 		self.embeddings=None
+		self.chunk_lookup={}
+		self.subject_chunk_ids={}
+		self.unit_embeddings=None
+		self.mmr_lambda=0.7
+		self.chunk_hashes=[]
+		self.question_bank=None
+		self.context_turns=CHAT_CONTEXT_TURNS
+		self.summary_chars=CHAT_SUMMARY_CHARS
+		self.reuse_ratio=0.8
+		self.context_tokens=CHAT_CONTEXT_TOKENS
+		self.chunk_overlap=CHUNK_OVERLAP
+		self.reranker=None
+		self.rerank_candidates=RERANK_CANDIDATES
 		self.alpha=0.7
 		self.last_time=0
 		self.delay=2.0
+		self.rate_lock=threading.Lock()
+		self.quiz_workers=QUIZ_GENERATION_WORKERS
+		self.quiz_delay=QUIZ_GENERATION_DELAY
+		self.quiz_overgenerate=QUIZ_OVERGENERATION
+		self.quiz_batch_size=QUIZ_BATCH_SIZE
+		self.json_mode=True
+		self.stage_local=threading.local()
 
-	def chunk_text(self,text,chunk_size=500,overlap=50,subject_id=None):
+	def chunk_text(self,text,chunk_size=500,overlap=CHUNK_OVERLAP,subject_id=None):
 		word_list=text.split()
 		chunk_list=[]
 		step_size=chunk_size-overlap
@@ -45,16 +95,32 @@ class SmartStudyRAG:
 		except Exception:
 			return ""
 
-	def rate_limit(self):
-		now=time.time()
-		elapsed=now-self.last_time
-		if elapsed<self.delay:
-			time.sleep(self.delay-elapsed)
-		self.last_time=time.time()
+	def rate_limit(self,delay=None):
+		delay=self.delay if delay is None else delay
+		with self.rate_lock:
+			now=time.time()
+			slot=max(now,self.last_time+delay)
+			self.last_time=slot
+		if slot>now:
+			start=time.perf_counter()
+			time.sleep(slot-now)
+			self._lap('rate_limit',start)
+
+	def _lap(self,stage,start):
+		now=time.perf_counter()
+		timings=getattr(self.stage_local,'timings',None)
+		if timings is not None:
+			timings[stage]=timings.get(stage,0.0)+(now-start)*1000
+		return now
+
+	def last_timings(self):
+		return {k:round(v,2) for k,v in (getattr(self.stage_local,'timings',None) or {}).items()}
 
 	def get_embeddings(self,text_list):
 		self.rate_limit()
+		start=time.perf_counter()
 		embed_response=self.client.embed(texts=text_list,model='embed-english-v3.0',input_type='search_document')
+		self._lap('embed',start)
 		return np.array(embed_response.embeddings)
 
 	def build_index(self,file_list,subject_id=None):
@@ -89,6 +155,7 @@ class SmartStudyRAG:
 		k_value=min(10,max(1,embed_count))
 		self.nn=NearestNeighbors(n_neighbors=k_value,metric='cosine')
 		self.nn.fit(self.embeddings)
+		self._index_subjects()
 
 	def normalize_query(self,query_text):
 		query_lower=query_text.lower().strip()
@@ -104,12 +171,15 @@ class SmartStudyRAG:
 		if not self.chunks or self.bm25 is None or self.nn is None:
 			return []
 		
+		t=time.perf_counter()
 		normalized_query=self.normalize_query(query_text)
 		query_words=normalized_query.split()
 		if not query_words:
 			query_words=query_text.lower().split()
+		t=self._lap('normalize',t)
 		
 		bm25_scores=self.bm25.get_scores(query_words)
+		t=self._lap('bm25',t)
 		
 		search_query=normalized_query if normalized_query and normalized_query!=query_text.lower() else query_text
 		query_embedding=self.get_embeddings([search_query])
@@ -118,16 +188,20 @@ class SmartStudyRAG:
 		if chunk_count==0:
 			return []
 		
+		t=time.perf_counter()
+		fit_count=getattr(self.nn,'n_samples_fit_',chunk_count)
+		pool_k=self.rerank_candidates if self.reranker is not None else self.nn.n_neighbors
 		try:
-			max_k=min(self.nn.n_neighbors,chunk_count)
+			max_k=min(max(pool_k,self.nn.n_neighbors),chunk_count,fit_count)
 			nn_distances,nn_indices=self.nn.kneighbors(query_embedding,n_neighbors=max_k)
 		except ValueError:
-			nn_distances,nn_indices=self.nn.kneighbors(query_embedding,n_neighbors=chunk_count)
+			nn_distances,nn_indices=self.nn.kneighbors(query_embedding,n_neighbors=min(chunk_count,fit_count))
+		t=self._lap('vector',t)
 		
 		scores=[]
 		nn_scores={}
 		if len(nn_indices[0])>0:
-			for i,chunk_idx in enumerate(nn_indices[0]):
+			for i,chunk_idx in enumerate(nn_indices[0][:self.nn.n_neighbors]):
 				dist=nn_distances[0][i] if i<len(nn_distances[0]) else 1.0
 				nn_scores[chunk_idx]=1-dist
 		
@@ -137,6 +211,17 @@ class SmartStudyRAG:
 			combined=self.alpha*bm25_score+(1-self.alpha)*nn_score
 			scores.append((i,combined))
 		scores.sort(key=lambda x:x[1],reverse=True)
+		t=self._lap('fusion',t)
+		
+		rerank_scores={}
+		if self.reranker is not None:
+			pool=[int(i) for i in np.argsort(-bm25_scores,kind='stable')[:self.rerank_candidates]]
+			in_pool=set(pool)
+			pool+=[int(i) for i in nn_indices[0] if int(i) not in in_pool]
+			ranked,rerank_scores=self.reranker.rerank(query_text,pool,query_embedding)
+			fused=dict(scores)
+			scores=[(idx,fused[idx]) for idx in ranked]
+			t=self._lap('rerank',t)
 		
 		results=[]
 		file_counts={}
@@ -147,20 +232,27 @@ class SmartStudyRAG:
 			fname=self.meta[idx]['file']
 			count=file_counts.get(fname,0)
 			if count<max_per_file:
-				results.append({'chunk':self.chunks[idx],'score':score,'metadata':self.meta[idx]})
+				result={'chunk':self.chunks[idx],'score':score,'metadata':self.meta[idx]}
+				if idx in rerank_scores:
+					result['rerank_score']=rerank_scores[idx]
+				results.append(result)
 				file_counts[fname]=count+1
+		self._lap('fusion',t)
 		return results
 
-	def generate_answer(self,question_text,search_results_list,user_grade=None):
+	def generate_answer(self,question_text,search_results_list,user_grade=None,chat_history=None,summary=""):
 		if not search_results_list:
+			NO_ANSWER_COUNTER.inc('no_results')
 			return "I'm sorry, I couldn't find information to answer that question in the available materials."
 		
-		parts=[r['chunk'] for r in search_results_list]
-		context="\n\n".join(parts)
+		t=time.perf_counter()
+		documents=self.pack_context(search_results_list)
+		self._lap('pack',t)
 		
 		avg_score=sum(r.get('score',0) for r in search_results_list)/len(search_results_list) if search_results_list else 0
 		
 		if avg_score<0.2:
+			NO_ANSWER_COUNTER.inc('low_score')
 			return "I'm sorry, I couldn't find relevant information to answer that question in the available materials."
 		
 		self.rate_limit()
@@ -168,14 +260,17 @@ class SmartStudyRAG:
 		if user_grade:
 			grade_prompt=f"\n\nStudent is in {user_grade} grade. Use appropriate language."
 		
+		if summary:
+			grade_prompt+=f"\n\nConversation so far: {summary}"
+		
 		normalized=self.normalize_query(question_text)
 		query_variants=[question_text]
-		if normalized and normalized!=question_text.lower():
+		if normalized and normalized!=question_text.lower() and not chat_history:
 			query_variants.append(f"Tell me about {normalized}")
 			query_variants.append(f"Explain {normalized}")
 		
 		best_answer=""
-		for variant in query_variants:
+		for n,variant in enumerate(query_variants,1):
 			preamble=f"""You are a helpful tutor. Answer the question using ONLY the information provided in the context below. 
 - If the answer is clearly in the context, provide a clear and comprehensive answer.
 - If you find relevant information even if not perfectly matching, use it to answer.
@@ -184,14 +279,16 @@ class SmartStudyRAG:
 
 Format: plain text, no code blocks or special formatting. Be clear and informative."""
 			
+			t=time.perf_counter()
 			try:
 				resp=self.client.chat(
 					message=variant,
 					model='command-a-03-2025',
 					preamble=preamble,
-					chat_history=[],
-					documents=[{"text":context}]
+					chat_history=chat_history or [],
+					documents=documents
 				)
+				self._lap(f'llm_variant_{n}',t)
 				ans=resp.text.strip()
 				
 				if ans and len(ans)>10:
@@ -203,22 +300,26 @@ Format: plain text, no code blocks or special formatting. Be clear and informati
 					elif not best_answer:
 						best_answer=ans
 			except Exception:
+				t=self._lap(f'llm_variant_{n}',t)
 				try:
 					resp=self.client.chat(
 						message=variant,
 						model='command',
 						preamble=preamble,
-						chat_history=[],
-						documents=[{"text":context}]
+						chat_history=chat_history or [],
+						documents=documents
 					)
+					self._lap('llm_fallback',t)
 					ans=resp.text.strip()
 					if ans and len(ans)>10:
 						best_answer=ans
 						break
 				except Exception:
+					self._lap('llm_fallback',t)
 					continue
 		
 		if not best_answer:
+			NO_ANSWER_COUNTER.inc('llm')
 			best_answer="I'm sorry, I couldn't find a clear answer to that question in the available materials."
 		
 		if best_answer.startswith('```'):
@@ -228,64 +329,127 @@ Format: plain text, no code blocks or special formatting. Be clear and informati
 		
 		return best_answer.strip()
 
-	def generate_quiz(self,num_questions=5,description="",subject_id=None,difficulty="medium",existing_questions=None):
-		if not self.chunks:
+	def _token_count(self,word_count):
+		return int(math.ceil(word_count*TOKENS_PER_WORD))
+
+	def _merge_windows(self,results):
+		groups={}
+		for order,r in enumerate(results):
+			r=dict(r,rank=order)
+			meta=r.get('metadata') or {}
+			cid=meta.get('chunk_id')
+			key=(meta.get('file_path') or meta.get('file')) if isinstance(cid,int) else ('result',order)
+			groups.setdefault(key,[]).append(r)
+		windows=[]
+		for group in groups.values():
+			group.sort(key=lambda r:r['metadata'].get('chunk_id') or 0)
+			current=None
+			for r in group:
+				cid=r['metadata'].get('chunk_id')
+				words=r['chunk'].split()
+				if current and isinstance(cid,int) and cid==current['last']+1:
+					prev=current['words']
+					k=min(self.chunk_overlap,len(prev),len(words))
+					while k>0 and prev[-k:]!=words[:k]:
+						k-=1
+					prev.extend(words[k:])
+					current['last']=cid
+					current['rank']=min(current['rank'],r['rank'])
+					continue
+				current={'words':list(words),'first':cid,'last':cid,'rank':r['rank'],'file':r['metadata'].get('file','Unknown')}
+				windows.append(current)
+		windows.sort(key=lambda w:w['rank'])
+		return windows
+
+	def pack_context(self,search_results_list,token_budget=None):
+		budget=self.context_tokens if token_budget is None else token_budget
+		picked=[]
+		seen=set()
+		windows=[]
+		for r in search_results_list:
+			text=r['chunk'].strip()
+			if not text or text in seen:
+				continue
+			candidate=self._merge_windows(picked+[r])
+			if sum(self._token_count(len(w['words'])) for w in candidate)>budget:
+				if picked:
+					continue
+				words=text.split()[:max(1,int(budget/TOKENS_PER_WORD))]
+				r=dict(r,chunk=' '.join(words))
+				candidate=self._merge_windows([r])
+			seen.add(text)
+			picked.append(r)
+			windows=candidate
+		documents=[]
+		for n,w in enumerate(windows,1):
+			span='' if w['first'] is None else f" (chunk {w['first']})" if w['first']==w['last'] else f" (chunks {w['first']}-{w['last']})"
+			documents.append({'id':f"doc_{n}",'title':f"{w['file']}{span}",'text':' '.join(w['words'])})
+		return documents
+
+	def _index_subjects(self):
+		subject_ids={}
+		for i,m in enumerate(self.meta):
+			subject_ids.setdefault(m.get('subject_id'),[]).append(i)
+		self.subject_chunk_ids={subj:np.array(ids,dtype=np.int64) for subj,ids in subject_ids.items()}
+		norms=np.linalg.norm(self.embeddings,axis=1,keepdims=True)
+		self.unit_embeddings=self.embeddings/np.where(norms==0,1,norms)
+		self.chunk_hashes=[hashlib.sha1(chunk.encode('utf-8')).hexdigest() for chunk in self.chunks]
+
+	def _subject_chunk_ids(self,subject_id=None):
+		if not subject_id:
+			return np.arange(len(self.chunks))
+		return self.subject_chunk_ids.get(int(subject_id),np.array([],dtype=np.int64))
+
+	def sample_quiz_chunks(self,count,subject_id=None,description=""):
+		ids=self._subject_chunk_ids(subject_id)
+		if not len(ids) or count<=0:
 			return []
-		if subject_id:
-			filtered=[]
-			for i,chunk in enumerate(self.chunks):
-				if i<len(self.meta):
-					subj=self.meta[i].get('subject_id')
-					if subj==int(subject_id):
-						filtered.append(chunk)
-			if not filtered:
-				return []
-			chunks=filtered
+		relevance=np.ones(len(ids))
+		terms=self.normalize_query(description).split() if description else []
+		if terms and self.bm25 is not None:
+			scores=np.asarray(self.bm25.get_scores(terms))[ids]
+			if scores.max()>0:
+				relevance=0.25+0.75*scores/scores.max()
+		if self.unit_embeddings is None:
+			order=np.argsort(-relevance,kind='stable')
 		else:
-			chunks=self.chunks
-		quiz_list=[]
-		used=set()
-		existing_text=""
-		if existing_questions:
-			existing_text="\n\nEXISTING QUESTIONS TO AVOID DUPLICATING:\n"
-			for i,q in enumerate(existing_questions):
-				existing_text+=f"{i+1}. {q.get('question','')}\n"
-		
+			vectors=self.unit_embeddings[ids]
+			max_sim=np.full(len(ids),-1.0)
+			picked=np.zeros(len(ids),dtype=bool)
+			order=[]
+			for _ in range(min(count,len(ids))):
+				mmr=self.mmr_lambda*relevance-(1-self.mmr_lambda)*np.maximum(max_sim,0)
+				mmr[picked]=-np.inf
+				best=int(np.argmax(mmr))
+				order.append(best)
+				picked[best]=True
+				max_sim=np.maximum(max_sim,vectors@vectors[best])
+			order=np.array(order)
+		return [int(ids[order[i%len(order)]]) for i in range(count)]
+
+	def _quiz_context(self,chunk_idx):
+		combined=self.chunks[chunk_idx]
+		meta=self.meta[chunk_idx]
+		for neighbor in (chunk_idx+1,chunk_idx-1):
+			if 0<=neighbor<len(self.chunks) and self.meta[neighbor].get('file_path')==meta.get('file_path'):
+				return combined+"\n\n"+self.chunks[neighbor][:500]
+		return combined
+
+	def _quiz_prompt(self,combined,difficulty,description="",existing_text=""):
 		difficulty_map={
 			"easy":"Create questions that test basic recall and understanding of fundamental concepts. Use straightforward language. The correct answer should be clearly identifiable from the content.",
 			"medium":"Create questions that require applying concepts and analyzing relationships. Include some reasoning but keep it accessible. Options should be plausible but distinguishable with proper understanding.",
 			"hard":"Create questions that require complex reasoning, synthesis of multiple concepts, and critical thinking. Include subtle distinctions between options. Test deep understanding and ability to apply knowledge in new contexts."
 		}
 		difficulty_guide=difficulty_map.get(difficulty,"Create questions that test understanding of the content.")
-		
-		for q_num in range(num_questions):
-			available=[j for j in range(len(chunks)) if j not in used]
-			if not available:
-				available=list(range(len(chunks)))
-				used.clear()
-			idx=available[q_num%len(available)]
-			chunk=chunks[idx]
-			used.add(idx)
-			combined=chunk
-			if len(chunks)>1:
-				extra=[]
-				for j in range(min(2,len(chunks))):
-					if j!=idx and j not in used:
-						extra.append(chunks[j][:500])
-				if extra:
-					combined=chunk+"\n\n"+"\n\n".join(extra)
-            
-			try:
-				self.rate_limit()
-				if description:
-					prompt=f"""Create a multiple choice question:
+		requirements=f"Requirements: {description}\n" if description else ""
+		return f"""Create a multiple choice question:
 
 {combined[:2000]}
 
 Difficulty: {difficulty}
 Guide: {difficulty_guide}
-Requirements: {description}
-{existing_text}
+{requirements}{existing_text}
 
 Format:
 Question: [question]
@@ -296,66 +460,227 @@ D) [option]
 Answer: A
 
 Answer must be A, B, C, or D. Use markdown."""
-				else:
-					prompt=f"""Create a multiple choice question:
 
-{combined[:2000]}
+	def _quiz_batch_prompt(self,contexts,difficulty,description="",existing_text=""):
+		difficulty_map={
+			"easy":"Test basic recall and understanding of fundamental concepts with straightforward language.",
+			"medium":"Require applying concepts and analyzing relationships; options should be plausible but distinguishable.",
+			"hard":"Require complex reasoning and synthesis of multiple concepts, with subtle distinctions between options."
+		}
+		excerpts="\n\n".join(f"Excerpt {i+1}:\n{context[:1500]}" for i,context in enumerate(contexts))
+		requirements=f"Requirements: {description}\n" if description else ""
+		return f"""Create {len(contexts)} multiple choice questions, one per excerpt:
+
+{excerpts}
 
 Difficulty: {difficulty}
-Guide: {difficulty_guide}
-{existing_text}
+Guide: {difficulty_map.get(difficulty,"Test understanding of the content.")}
+{requirements}{existing_text}
 
-Format:
-Question: [question]
-A) [option]
-B) [option]
-C) [option]
-D) [option]
-Answer: A
+Return JSON only, no markdown:
+{{"questions": [{{"excerpt": 1, "question": "...", "options": ["...", "...", "...", "..."], "answer": "A"}}]}}
 
-Answer must be A, B, C, or D. Use markdown."""
-				resp=self.client.chat(message=prompt,model='command-a-03-2025',preamble=f"Create {difficulty} quiz questions. Follow format. Answer is A/B/C/D.",chat_history=[])
-				text=resp.text.strip()
-				q,opts,correct="",[],""
-				lines=text.split('\n')
-				for line in lines:
-					line=line.strip()
-					if line.startswith('Question:'):
-						q=line.replace('Question:','').strip()
-					elif line.startswith('A)'):
-						opts.append(line.replace('A)','').strip())
-					elif line.startswith('B)'):
-						opts.append(line.replace('B)','').strip())
-					elif line.startswith('C)'):
-						opts.append(line.replace('C)','').strip())
-					elif line.startswith('D)'):
-						opts.append(line.replace('D)','').strip())
-					elif line.startswith('Answer:'):
-						correct=line.replace('Answer:','').strip().upper()
-				if q and len(opts)==4 and correct in ['A','B','C','D']:
-					dup=False
-					if existing_questions:
-						for eq in existing_questions:
-							if self._questions_similar(q,eq.get('question','')):
-								dup=True
-								break
-					if not dup:
-						quiz_list.append({'question':q,'options':opts,'correct':correct,'type':'multiple_choice'})
-			except Exception:
-				pass
-		return quiz_list
-
-	def _questions_similar(self,q1,q2,threshold=0.8):
-		if not q1 or not q2:
-			return False
-		word_set1=set(q1.lower().split())
-		word_set2=set(q2.lower().split())
-		if not word_set1 or not word_set2:
-			return False
-		common_words=len(word_set1.intersection(word_set2))
-		all_words=len(word_set1.union(word_set2))
-		similarity_ratio=common_words/all_words if all_words>0 else 0
-		return similarity_ratio>=threshold
+Each question has exactly 4 options and answer is A, B, C, or D."""
+
+	def _extract_json(self,text):
+		fence=re.search(r'```(?:json)?\s*(.*?)```',text,re.S)
+		if fence:
+			text=fence.group(1)
+		starts=[i for i in (text.find('{'),text.find('[')) if i>=0]
+		if not starts:
+			return None
+		body=text[min(starts):max(text.rfind('}'),text.rfind(']'))+1]
+		for candidate in (body,re.sub(r',\s*([\]}])',r'\1',body)):
+			try:
+				return json.loads(candidate)
+			except ValueError:
+				continue
+		return None
+
+	def _normalize_question(self,item):
+		if not isinstance(item,dict):
+			return None
+		q=str(item.get('question') or item.get('q') or '').strip()
+		opts=item.get('options') or item.get('choices') or []
+		if isinstance(opts,dict):
+			opts=[opts.get(k,opts.get(k.lower())) for k in 'ABCD']
+		if not isinstance(opts,list):
+			return None
+		opts=[re.sub(r'^[A-Da-d][\).:]\s+','',str(o).strip()) for o in opts if o is not None and str(o).strip()]
+		answer=item.get('answer',item.get('correct',''))
+		correct=""
+		if isinstance(answer,int) and not isinstance(answer,bool) and 0<=answer<4:
+			correct='ABCD'[answer]
+		else:
+			answer=str(answer).strip()
+			if answer in opts:
+				correct='ABCD'[opts.index(answer)] if opts.index(answer)<4 else ""
+			else:
+				m=re.match(r'^(?:option\s+)?([A-Da-d])(?:[\).:]|\s|$)',answer,re.I)
+				if m:
+					correct=m.group(1).upper()
+		if q and len(opts)==4 and correct:
+			return {'question':q,'options':opts,'correct':correct,'type':'multiple_choice'}
+		return None
+
+	def _parse_quiz_batch(self,text):
+		data=self._extract_json(text)
+		if isinstance(data,dict):
+			data=data.get('questions',[data])
+		if isinstance(data,list):
+			return [(item.get('excerpt'),q) for item,q in ((item,self._normalize_question(item)) for item in data) if q]
+		blocks=re.split(r'(?=^\s*\**\s*Question\s*\d*\s*:)',text,flags=re.M)
+		return [(None,q) for q in (self._parse_quiz_response(block) for block in blocks) if q]
+
+	def _assign_excerpts(self,items,count):
+		assigned={}
+		leftovers=[]
+		for excerpt,q in items:
+			if isinstance(excerpt,int) and 1<=excerpt<=count and excerpt-1 not in assigned:
+				assigned[excerpt-1]=q
+			else:
+				leftovers.append(q)
+		for pos,q in zip([i for i in range(count) if i not in assigned],leftovers):
+			assigned[pos]=q
+		return assigned
+
+	def _parse_quiz_response(self,text):
+		q,opts,correct="",[],""
+		for line in text.strip().split('\n'):
+			line=re.sub(r'\*\*|__','',line).strip()
+			option=re.match(r'^([A-D])[\).:]\s*(.*)',line)
+			if re.match(r'^Question\s*\d*\s*:',line):
+				q=line.split(':',1)[1].strip()
+			elif option:
+				opts.append(option.group(2).strip())
+			elif line.startswith('Answer:'):
+				correct=line.replace('Answer:','').strip().upper()[:1]
+		if q and len(opts)==4 and correct in ['A','B','C','D']:
+			return {'question':q,'options':opts,'correct':correct,'type':'multiple_choice'}
+		return None
+
+	def _generate_question(self,prompt,difficulty):
+		try:
+			self.rate_limit(self.quiz_delay)
+			resp=self.client.chat(message=prompt,model='command-a-03-2025',preamble=f"Create {difficulty} quiz questions. Follow format. Answer is A/B/C/D.",chat_history=[])
+			return self._parse_quiz_response(resp.text)
+		except Exception:
+			return None
+
+	def _generate_batch(self,contexts,difficulty,description="",existing_text=""):
+		prompt=self._quiz_batch_prompt(contexts,difficulty,description,existing_text)
+		preamble=f"Create {difficulty} quiz questions. Respond with JSON only. Answer is A/B/C/D."
+		try:
+			self.rate_limit(self.quiz_delay)
+			if self.json_mode:
+				try:
+					resp=self.client.chat(message=prompt,model='command-a-03-2025',preamble=preamble,chat_history=[],response_format={'type':'json_object','schema':QUIZ_BATCH_SCHEMA})
+				except TypeError:
+					self.json_mode=False
+					self.rate_limit(self.quiz_delay)
+			if not self.json_mode:
+				resp=self.client.chat(message=prompt,model='command-a-03-2025',preamble=preamble,chat_history=[])
+			return self._assign_excerpts(self._parse_quiz_batch(resp.text),len(contexts))
+		except Exception:
+			return {}
+
+	def _generate_questions(self,chunk_ids,difficulty,description="",existing_text="",stop=None):
+		if stop is not None and stop.is_set():
+			return []
+		contexts=[self._quiz_context(idx) for idx in chunk_ids]
+		found=self._generate_batch(contexts,difficulty,description,existing_text) if len(contexts)>1 else {}
+		results=[]
+		for pos,chunk_idx in enumerate(chunk_ids):
+			if stop is not None and stop.is_set():
+				break
+			question=found.get(pos) or self._generate_question(self._quiz_prompt(contexts[pos],difficulty,description,existing_text),difficulty)
+			if question:
+				results.append((chunk_idx,question))
+		return results
+
+	def _bank_entry(self,chunk_idx,question,difficulty):
+		meta=self.meta[chunk_idx]
+		return dict(question,chunk_hash=self.chunk_hashes[chunk_idx],difficulty=difficulty,prompt_version=QUIZ_PROMPT_VERSION,
+			subject_id=meta.get('subject_id'),material_id=meta.get('material_id'),chunk_id=meta.get('chunk_id'))
+
+	def iter_quiz_questions(self,num_questions=5,description="",subject_id=None,difficulty="medium",existing_questions=None,workers=None,overgenerate=None,batch_size=None,subject_index=None,use_bank=True):
+		if not self.chunks or num_questions<=0:
+			return
+		workers=max(1,workers or self.quiz_workers)
+		batch_size=max(1,batch_size or self.quiz_batch_size)
+		overgenerate=self.quiz_overgenerate if overgenerate is None else overgenerate
+		budget=num_questions+math.ceil(num_questions*overgenerate)
+		plan=self.sample_quiz_chunks(budget,subject_id,description)
+		if not plan:
+			return
+		existing_text=""
+		if existing_questions:
+			existing_text="\n\nEXISTING QUESTIONS TO AVOID DUPLICATING:\n"
+			for i,q in enumerate(existing_questions):
+				existing_text+=f"{i+1}. {q.get('question','')}\n"
+		seen=MinHashIndex()
+		for i,q in enumerate(existing_questions or []):
+			seen.add(('existing',i),q.get('question',''))
+		accepted=0
+		if self.question_bank is not None and use_bank:
+			banked=self.question_bank.lookup({self.chunk_hashes[idx] for idx in plan},difficulty,QUIZ_PROMPT_VERSION)
+			gaps=[]
+			picked=[]
+			skipped=[]
+			for idx in plan:
+				candidates=banked.get(self.chunk_hashes[idx],[])
+				while candidates and accepted+len(picked)<num_questions:
+					question=candidates.pop(0)
+					bank_id=question.pop('id')
+					if seen.add_if_new(('bank',bank_id),question['question']):
+						picked.append((bank_id,question))
+						break
+					skipped.append(bank_id)
+				else:
+					gaps.append(idx)
+			self.question_bank.mark_served([bank_id for bank_id,_ in picked]+skipped)
+			for _,question in picked:
+				accepted+=1
+				QUIZ_SOURCE_COUNTER.inc('bank')
+				yield question
+			plan=gaps[:budget-accepted]
+			budget=len(plan)
+		submitted=0
+		in_flight=0
+		executor=ThreadPoolExecutor(max_workers=workers)
+		stop=threading.Event()
+		try:
+			pending={}
+			while accepted<num_questions:
+				need=num_questions-accepted
+				target=need+math.ceil(need*overgenerate)
+				while submitted<budget and len(pending)<workers and in_flight<target:
+					count=min(batch_size,budget-submitted,target-in_flight)
+					pending[executor.submit(self._generate_questions,plan[submitted:submitted+count],difficulty,description,existing_text,stop)]=count
+					submitted+=count
+					in_flight+=count
+				if not pending:
+					break
+				done,_=wait(pending,return_when=FIRST_COMPLETED)
+				for future in done:
+					in_flight-=pending.pop(future)
+					results=[(chunk_idx,question) for chunk_idx,question in future.result() if subject_index is None or subject_index.find_similar(question['question']) is None]
+					if self.question_bank is not None:
+						self.question_bank.store([self._bank_entry(chunk_idx,question,difficulty) for chunk_idx,question in results])
+					for chunk_idx,question in results:
+						if accepted>=num_questions:
+							break
+						if not seen.add_if_new(('new',accepted),question['question']):
+							continue
+						accepted+=1
+						QUIZ_SOURCE_COUNTER.inc('generated')
+						yield question
+		finally:
+			stop.set()
+			executor.shutdown(wait=True,cancel_futures=True)
+
+	def generate_quiz(self,num_questions=5,description="",subject_id=None,difficulty="medium",existing_questions=None,workers=None,overgenerate=None,batch_size=None,subject_index=None,use_bank=True):
+		return list(self.iter_quiz_questions(num_questions,description,subject_id,difficulty,existing_questions,workers,overgenerate,batch_size,subject_index,use_bank))
 
 	def rebuild_from_db(self,material_list):
 		all_chunks,all_meta=[],[]
@@ -374,10 +699,11 @@ Answer must be A, B, C, or D. Use markdown."""
 			chunks=self.chunk_text(content,subject_id=subj)
 			for i,chunk in enumerate(chunks):
 				all_chunks.append(chunk)
-				all_meta.append({'file':fname,'chunk_id':i,'file_path':f"db:{mat_id}",'subject_id':subj})
+				all_meta.append({'file':fname,'chunk_id':i,'file_path':f"db:{mat_id}",'subject_id':subj,'material_id':mat_id})
 		if all_chunks:
 			self.chunks=all_chunks
 			self.meta=all_meta
+			self.chunk_lookup={(m['material_id'],m['chunk_id']):i for i,m in enumerate(all_meta)}
 			tokenized_list=[chunk.lower().split() for chunk in all_chunks]
 			self.bm25=BM25Okapi(tokenized_list)
 			self.embeddings=self.get_embeddings(all_chunks)
@@ -385,8 +711,91 @@ Answer must be A, B, C, or D. Use markdown."""
 			k_val=min(10,max(1,embed_count))
 			self.nn=NearestNeighbors(n_neighbors=k_val,metric='cosine')
 			self.nn.fit(self.embeddings)
+			self._index_subjects()
+
+	def resolve_chunk_refs(self,ref_list):
+		resolved=[]
+		for ref in ref_list:
+			if 'metadata' in ref:
+				resolved.append(ref)
+				continue
+			idx=self.chunk_lookup.get((ref.get('material_id'),ref.get('chunk_id')))
+			if idx is not None:
+				resolved.append({'chunk':self.chunks[idx],'score':ref.get('score',0),'metadata':self.meta[idx]})
+			else:
+				resolved.append({'chunk':ref.get('chunk',''),'score':ref.get('score',0),'metadata':{'file':'correction' if ref.get('chunk') else 'Unknown','chunk_id':ref.get('chunk_id')}})
+		return resolved
 
-	def query(self,question_text,top_k=5,user_grade=None):
-		search_results=self.search(question_text,top_k)
-		answer_text=self.generate_answer(question_text,search_results,user_grade=user_grade)
+	def _query_terms(self,text):
+		return re.findall(r'\w+',self.normalize_query(text))
+
+	def rewrite_query(self,question_text,conversation):
+		turns=conversation.get('turns') or []
+		words=[w.strip('?.,!;:') for w in question_text.lower().split()]
+		if not turns or not words:
+			return question_text,False
+		terms=self._query_terms(question_text)
+		followup=(not terms or any(w in FOLLOWUP_PRONOUNS for w in words)
+			or words[0] in FOLLOWUP_STARTERS or ' '.join(words[:2]) in FOLLOWUP_STARTERS)
+		if not followup:
+			return question_text,False
+		previous=[t for t in self._query_terms(turns[-1]['question']) if t not in FOLLOWUP_PRONOUNS]
+		extra=[t for t in previous if t not in terms]
+		return ' '.join([question_text]+extra),True
+
+	def _reuse_chunks(self,search_text,refs,top_k):
+		if not refs or self.bm25 is None:
+			return None
+		ref_idx={}
+		for ref in refs:
+			idx=self.chunk_lookup.get((ref.get('material_id'),ref.get('chunk_id')))
+			if idx is not None:
+				ref_idx[idx]=ref.get('score',0)
+		terms=self._query_terms(search_text)
+		if not ref_idx or not terms:
+			return None
+		scores=self.bm25.get_scores(terms)
+		best=scores.max()
+		ids=sorted(ref_idx,key=lambda i:scores[i],reverse=True)
+		if best<=0 or scores[ids[0]]<self.reuse_ratio*best:
+			return None
+		return [{'chunk':self.chunks[i],'score':ref_idx[i],'metadata':self.meta[i]} for i in ids[:top_k]]
+
+	def update_summary(self,summary,question_text,answer_text):
+		first_sentence=re.split(r'(?<=[.!?])\s',answer_text.strip(),maxsplit=1)[0][:150]
+		segments=[seg for seg in (summary or '').split(' | ') if seg]+[f"Q: {question_text[:150]} A: {first_sentence}"]
+		while len(segments)>1 and len(' | '.join(segments))>self.summary_chars:
+			segments.pop(0)
+		return ' | '.join(segments)[-self.summary_chars:]
+
+	def query(self,question_text,top_k=5,user_grade=None,conversation=None):
+		self.stage_local.timings={}
+		start=time.perf_counter()
+		if not conversation or not conversation.get('turns'):
+			search_results=self.search(question_text,top_k)
+			answer_text=self.generate_answer(question_text,search_results,user_grade=user_grade,summary=(conversation or {}).get('summary',''))
+			self._finish_query('single',start)
+			return answer_text,search_results
+		t=time.perf_counter()
+		search_text,followup=self.rewrite_query(question_text,conversation)
+		t=self._lap('rewrite',t)
+		search_results=self._reuse_chunks(search_text,conversation['turns'][-1].get('source_chunks'),top_k) if followup else None
+		if followup:
+			self._lap('reuse',t)
+			REUSE_COUNTER.inc('miss' if search_results is None else 'hit')
+		if search_results is None:
+			search_results=self.search(search_text,top_k)
+		chat_history=[]
+		for turn in conversation['turns'][-self.context_turns:]:
+			chat_history.append({'role':'USER','message':turn['question']})
+			chat_history.append({'role':'CHATBOT','message':turn['answer'][:500]})
+		answer_text=self.generate_answer(question_text,search_results,user_grade=user_grade,chat_history=chat_history,summary=conversation.get('summary',''))
+		self._finish_query('conversation',start)
 		return answer_text,search_results
+
+	def _finish_query(self,mode,start):
+		self._lap('total',start)
+		QUERY_COUNTER.inc(mode)
+		if metrics.enabled:
+			for stage,ms in self.stage_local.timings.items():
+				STAGE_LATENCY.observe(ms/1000,stage)
@@ -1,6 +1,10 @@
 import os
 from services.rag import SmartStudyRAG
+from services.fake_llm import FakeChatClient
+from services.question_bank import QuestionBank
+from services.rerank import create_reranker
 from database.db import get_materials
+from utils.config import LLM_CLIENT
 
 rag_instance = None
 
@@ -10,7 +14,10 @@ def init_rag_system():
         cohere_key = "4ChEA81Zn4SNyVFX9xMixi5yQcda1qZJG907k621"
         if not cohere_key:
             cohere_key = "nothing"
-        rag_instance = SmartStudyRAG(cohere_key)
+        client = FakeChatClient() if LLM_CLIENT == 'fake' else None
+        rag_instance = SmartStudyRAG(cohere_key, client=client)
+        rag_instance.question_bank = QuestionBank()
+        rag_instance.reranker = create_reranker(rag_instance)
     try:
         material_list = get_materials()
         if material_list:
@@ -0,0 +1,116 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.config import RERANK_MODE, RERANK_MODEL, RERANK_CACHE_SIZE
+from utils.metrics import registry as metrics
+
+cache_lookups = metrics.counter('rerank_cache_total', 'Rerank score cache lookups', ('outcome',))
+
+class HeuristicScorer:
+    def __init__(self, rag, embedding_weight=0.5):
+        self.rag = rag
+        self.embedding_weight = embedding_weight
+        self.tokens = {}
+        self.tokens_for = None
+
+    def _tokens(self, idx):
+        if self.tokens_for is not self.rag.chunks:
+            self.tokens = {}
+            self.tokens_for = self.rag.chunks
+        tokens = self.tokens.get(idx)
+        if tokens is None:
+            tokens = self.tokens[idx] = set(re.findall(r'\w+', self.rag.chunks[idx].lower()))
+        return tokens
+
+    def score(self, query_text, indices, query_embedding=None):
+        terms = set(self.rag._query_terms(query_text))
+        idf = self.rag.bm25.idf if self.rag.bm25 is not None else {}
+        weights = {t: idf.get(t, 0) if idf.get(t, 0) > 0 else 1.0 for t in terms}
+        total = sum(weights.values()) or 1.0
+        unit = self.rag.unit_embeddings
+        q = None
+        if query_embedding is not None and unit is not None:
+            q = np.asarray(query_embedding, dtype=float).ravel()
+            norm = np.linalg.norm(q)
+            q = q / norm if norm else None
+        scores = {}
+        for idx in indices:
+            tokens = self._tokens(idx)
+            lexical = sum(w for t, w in weights.items() if t in tokens) / total
+            semantic = max(float(unit[idx] @ q), 0.0) if q is not None and idx < len(unit) else 0.0
+            scores[idx] = (1 - self.embedding_weight) * lexical + self.embedding_weight * semantic
+        return scores
+
+class RemoteScorer:
+    def __init__(self, rag, model=RERANK_MODEL):
+        self.rag = rag
+        self.model = model
+
+    def score(self, query_text, indices, query_embedding=None):
+        self.rag.rate_limit()
+        start = time.perf_counter()
+        resp = self.rag.client.rerank(model=self.model, query=query_text,
+                                      documents=[self.rag.chunks[i] for i in indices], top_n=len(indices))
+        self.rag._lap('rerank_api', start)
+        scores = {idx: 0.0 for idx in indices}
+        for result in resp.results:
+            scores[indices[result.index]] = float(result.relevance_score)
+        return scores
+
+class Reranker:
+    def __init__(self, rag, scorer, fallback=None, cache_size=RERANK_CACHE_SIZE):
+        self.rag = rag
+        self.scorer = scorer
+        self.fallback = fallback
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _chunk_hash(self, idx):
+        if idx < len(self.rag.chunk_hashes):
+            return self.rag.chunk_hashes[idx]
+        return hashlib.sha1(self.rag.chunks[idx].encode('utf-8')).hexdigest()
+
+    def rerank(self, query_text, indices, query_embedding=None):
+        keys = {idx: (query_text, self._chunk_hash(idx)) for idx in indices}
+        scores, missing = {}, []
+        with self.lock:
+            for idx, key in keys.items():
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    scores[idx] = self.cache[key]
+                else:
+                    missing.append(idx)
+            self.hits += len(scores)
+            self.misses += len(missing)
+        cache_lookups.inc('hit', amount=len(scores))
+        cache_lookups.inc('miss', amount=len(missing))
+        if missing:
+            try:
+                fresh = self.scorer.score(query_text, missing, query_embedding)
+            except Exception:
+                if self.fallback is None:
+                    raise
+                scores.update(self.fallback.score(query_text, missing, query_embedding))
+            else:
+                with self.lock:
+                    for idx in missing:
+                        scores[idx] = fresh.get(idx, 0.0)
+                        self.cache[keys[idx]] = scores[idx]
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+        return sorted(indices, key=lambda i: scores[i], reverse=True), scores
+
+def create_reranker(rag, mode=RERANK_MODE):
+    if mode == 'heuristic':
+        return Reranker(rag, HeuristicScorer(rag))
+    if mode == 'cohere':
+        return Reranker(rag, RemoteScorer(rag), fallback=HeuristicScorer(rag))
+    return None
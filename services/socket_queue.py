@@ -0,0 +1,85 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import socketio
+
+class MemoryPubSubManager(socketio.PubSubManager):
+    name = 'memory'
+    subscribers = {}
+    subscribers_lock = threading.Lock()
+
+    def __init__(self, url='memory://', channel='socketio', write_only=False, logger=None, poll_interval=0.01):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.poll_interval = poll_interval
+        self.inbox = queue.Queue()
+        if not write_only:
+            with self.subscribers_lock:
+                self.subscribers.setdefault(channel, []).append(self.inbox)
+
+    def _publish(self, data):
+        with self.subscribers_lock:
+            inboxes = list(self.subscribers.get(self.channel, []))
+        for inbox in inboxes:
+            inbox.put(json.loads(json.dumps(data)))
+
+    def _listen(self):
+        while True:
+            try:
+                yield self.inbox.get_nowait()
+            except queue.Empty:
+                self.server.sleep(self.poll_interval)
+
+class SQLitePubSubManager(socketio.PubSubManager):
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None, poll_interval=0.05, retention=60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else url
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS socketio_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )''')
+        self.conn.commit()
+        self.last_prune = 0
+
+    def _publish(self, data):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT INTO socketio_messages (channel, payload, created_at) VALUES (?, ?, ?)', (self.channel, json.dumps(data), now))
+            if now - self.last_prune > self.retention:
+                self.conn.execute('DELETE FROM socketio_messages WHERE created_at < ?', (now - self.retention,))
+                self.last_prune = now
+            self.conn.commit()
+
+    def _listen(self):
+        with self.lock:
+            last_id = self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_messages').fetchone()[0]
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT id, payload FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id', (last_id, self.channel)).fetchall()
+            for message_id, payload in rows:
+                last_id = message_id
+                yield json.loads(payload)
+            if not rows:
+                self.server.sleep(self.poll_interval)
+
+def get_client_manager(url, channel='socketio', write_only=False):
+    if not url:
+        return None
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return socketio.RedisManager(url, channel=channel, write_only=write_only)
+    if url.startswith('memory://'):
+        return MemoryPubSubManager(url, channel=channel, write_only=write_only)
+    if url.startswith('sqlite:///'):
+        return SQLitePubSubManager(url, channel=channel, write_only=write_only)
+    raise ValueError(f'Unsupported SOCKETIO_MESSAGE_QUEUE: {url}')
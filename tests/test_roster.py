@@ -0,0 +1,17 @@
+import io
+
+from utils.roster import parse_roster_csv
+
+def parse(text):
+    return parse_roster_csv(io.BytesIO(text.encode('utf-8')))
+
+def test_extra_columns_are_reported_and_other_rows_kept():
+    rows, errors = parse('username,password,role,subjects\n'
+                         'u1,p,student,Bio\n'
+                         'u3,p,student,Bio,Chem\n'
+                         'u4,p,teacher,Bio;Chem\n')
+    assert [r['username'] for r in rows] == ['u1', 'u4']
+    assert rows[1]['subjects'] == ['Bio', 'Chem']
+    assert len(errors) == 1
+    assert errors[0][0] == 3
+    assert 'too many columns' in errors[0][1]
@@ -0,0 +1,30 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 10
+
+def compress_text(text):
+    if text is None:
+        return None, None
+    data = text.encode('utf-8')
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), 'zstd'
+    return zlib.compress(data, ZLIB_LEVEL), 'zlib'
+
+def decompress_text(data, codec):
+    if data is None:
+        return None
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd-compressed content')
+        return zstandard.ZstdDecompressor().decompress(bytes(data)).decode('utf-8')
+    if codec == 'zlib':
+        return zlib.decompress(bytes(data)).decode('utf-8')
+    if isinstance(data, (bytes, memoryview)):
+        return bytes(data).decode('utf-8')
+    return data
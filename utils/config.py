@@ -8,5 +8,43 @@ MAX_FILE_SIZE = 10 * 1024 * 1024
 SECRET_KEY = 'IB-Smartportal'
 PERMANENT_SESSION_LIFETIME = 86400
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///smart_study.db')
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+WRITE_BEHIND_QUEUE_SIZE = 10000
+WRITE_BEHIND_BATCH_SIZE = 200
+WRITE_BEHIND_FLUSH_INTERVAL = 0.5
+WRITE_BEHIND_SPOOL_FILE = 'write_behind_spool.jsonl'
+
+CHAT_HISTORY_STORE = os.environ.get('CHAT_HISTORY_STORE', 'memory')
+CHAT_HISTORY_TURNS = 10
+CHAT_HISTORY_MAX_SESSIONS = 10000
+CHAT_CONTEXT_TURNS = 3
+CHAT_SUMMARY_CHARS = 600
+CHAT_CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', 1500))
+CHUNK_OVERLAP = 50
+
+RERANK_MODE = os.environ.get('RERANK_MODE', 'off')
+RERANK_MODEL = 'rerank-english-v3.0'
+RERANK_CANDIDATES = 50
+RERANK_CACHE_SIZE = 50000
+
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
 
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+PROFILER_MODE = os.environ.get('PROFILER_MODE', 'sample')
+PROFILER_INTERVAL = 0.005
+PROFILER_MAX_PROFILES = 50
+
+LLM_CLIENT = os.environ.get('LLM_CLIENT', 'cohere')
+QUIZ_GENERATION_WORKERS = int(os.environ.get('QUIZ_GENERATION_WORKERS', 4))
+# Minimum spacing in seconds between quiz LLM calls across all workers; lower it only if the API key allows it.
+QUIZ_GENERATION_DELAY = float(os.environ.get('QUIZ_GENERATION_DELAY', 2.0))
+QUIZ_OVERGENERATION = 0.5
+QUIZ_BATCH_SIZE = 5
+
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
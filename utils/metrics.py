@@ -0,0 +1,185 @@
+import functools
+import threading
+import time
+
+from utils.config import METRICS_ENABLED, METRICS_BUCKETS
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class NullMetric:
+    def inc(self, *labels, amount=1):
+        pass
+
+    def dec(self, *labels, amount=1):
+        pass
+
+    def set(self, value, *labels):
+        pass
+
+    def observe(self, value, *labels):
+        pass
+
+NULL_METRIC = NullMetric()
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, _label_text(self.labelnames, k), v) for k, v in sorted(self.values.items())]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    out.append((self.name + '_bucket', _label_text(self.labelnames, labels, [('le', bound)]), cumulative))
+                out.append((self.name + '_bucket', _label_text(self.labelnames, labels, [('le', '+Inf')]), count))
+                out.append((self.name + '_sum', _label_text(self.labelnames, labels), total))
+                out.append((self.name + '_count', _label_text(self.labelnames, labels), count))
+        return out
+
+class MetricsRegistry:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labelnames, **kwargs):
+        if not self.enabled:
+            return NULL_METRIC
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._get(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=METRICS_BUCKETS):
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+def timed_functions(namespace, histogram, skip=()):
+    for name, fn in list(namespace.items()):
+        if name.startswith('_') or name in skip or not callable(fn) or getattr(fn, '__module__', None) != namespace['__name__']:
+            continue
+        if isinstance(fn, type):
+            continue
+        namespace[name] = _timed(fn, histogram)
+
+def _timed(fn, histogram):
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start, name)
+    return wrapper
+
+class InstrumentedClient:
+    def __init__(self, client, api_name='cohere'):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_requests', registry.counter('llm_requests_total', 'External LLM API calls', ('api', 'method', 'outcome')))
+        object.__setattr__(self, '_latency', registry.histogram('llm_request_duration_seconds', 'External LLM API call latency', ('api', 'method')))
+        object.__setattr__(self, '_api', api_name)
+
+    def _call(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = getattr(self._client, method)(*args, **kwargs)
+        except Exception:
+            self._requests.inc(self._api, method, 'error')
+            raise
+        finally:
+            self._latency.observe(time.perf_counter() - start, self._api, method)
+        self._requests.inc(self._api, method, 'ok')
+        return result
+
+    def chat(self, *args, **kwargs):
+        return self._call('chat', *args, **kwargs)
+
+    def embed(self, *args, **kwargs):
+        return self._call('embed', *args, **kwargs)
+
+    def rerank(self, *args, **kwargs):
+        return self._call('rerank', *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+def instrument_client(client):
+    return InstrumentedClient(client) if registry.enabled else client
@@ -0,0 +1,25 @@
+import csv
+import io
+
+ROSTER_ROLES = {'student', 'teacher', 'admin'}
+
+def parse_roster_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    if not reader.fieldnames or not {'username', 'password'} <= {f.strip().lower() for f in reader.fieldnames}:
+        raise ValueError('Roster must have username and password columns')
+    rows, errors = [], []
+    for line_no, raw in enumerate(reader, start=2):
+        if None in raw:
+            errors.append((line_no, f'too many columns (expected {len(reader.fieldnames)}); separate subjects with ";"'))
+            continue
+        row = {(k or '').strip().lower(): (v or '').strip() for k, v in raw.items()}
+        role = (row.get('role') or 'student').lower()
+        if not row.get('username') or not row.get('password'):
+            errors.append((line_no, 'missing username or password'))
+            continue
+        if role not in ROSTER_ROLES:
+            errors.append((line_no, f'unknown role {role}'))
+            continue
+        subjects = [s.strip() for s in row.get('subjects', '').replace('|', ';').split(';') if s.strip()]
+        rows.append({'username': row['username'], 'password': row['password'], 'role': role, 'subjects': subjects if role != 'admin' else []})
+    return rows, errors